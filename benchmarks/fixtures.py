@@ -0,0 +1,67 @@
+"""Database setup and generated fixtures for the benchmarks.
+
+The `tests` app models are created in a file-based SQLite database. For
+`rows` tags there are `rows // 10` libraries with three tags each and
+`rows // 100` users and hackers with five libraries each.
+"""
+import os
+import sys
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+import django  # noqa
+from django.conf import settings  # noqa
+
+
+def setup(path):
+    "Configures Django to use a new database at `path` and creates it."
+    settings.DATABASES['default']['NAME'] = path
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def generate(rows):
+    "Creates the fixtures for `rows` tags."
+    from django.contrib.auth.models import User
+    from tests.models import Tag, Library, Hacker
+
+    now = datetime.datetime(2010, 3, 3, 17, 40, 41)
+    libraries = max(rows // 10, 1)
+    hackers = max(rows // 100, 1)
+
+    Tag.objects.bulk_create([Tag(id=i, name='tag{0}'.format(i))
+                             for i in range(1, rows + 1)])
+
+    Library.objects.bulk_create([
+        Library(id=i, name='library{0}'.format(i),
+                url='https://example.com/{0}'.format(i),
+                language='python')
+        for i in range(1, libraries + 1)
+    ])
+
+    Library.tags.through.objects.bulk_create([
+        Library.tags.through(library_id=i, tag_id=(i * 3 + j) % rows + 1)
+        for i in range(1, libraries + 1) for j in range(min(3, rows))
+    ])
+
+    User.objects.bulk_create([
+        User(id=i, username='user{0}'.format(i), first_name='First',
+             last_name='Last', email='user{0}@example.com'.format(i),
+             password='!', last_login=now, date_joined=now)
+        for i in range(1, hackers + 1)
+    ])
+
+    Hacker.objects.bulk_create([
+        Hacker(user_id=i, website='https://example.com/~{0}'.format(i))
+        for i in range(1, hackers + 1)
+    ])
+
+    Hacker.libraries.through.objects.bulk_create([
+        Hacker.libraries.through(hacker_id=i,
+                                 library_id=(i * 5 + j) % libraries + 1)
+        for i in range(1, hackers + 1) for j in range(min(5, libraries))
+    ])
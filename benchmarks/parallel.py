@@ -0,0 +1,65 @@
+"""Benchmarks serializing a queryset with a pool of workers.
+
+Usage: python benchmarks/parallel.py [--rows 20000] [--workers 1,2,4,8]
+
+The rows are serialized with a CPU-bound posthook, once per executor and
+number of workers. A file-based SQLite database is created in a temporary
+directory since the processes each open their own connection (see
+`fixtures`).
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import hashlib
+
+import fixtures
+
+
+def posthook(instance, attrs):
+    digest = attrs['name'].encode('utf-8')
+
+    for _ in range(2000):
+        digest = hashlib.sha256(digest).digest()
+
+    attrs['digest'] = hashlib.sha256(digest).hexdigest()
+    return attrs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=20000)
+    parser.add_argument('--workers', default='1,2,4,8')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        fixtures.setup(os.path.join(directory, 'db'))
+        fixtures.generate(args.rows)
+
+        from tests.models import Tag
+        from preserialize.serialize import queryset_to_list
+
+        template = {'fields': ['id', 'name'], 'posthook': posthook}
+        print('{0} rows on {1} cores'.format(args.rows, os.cpu_count()))
+
+        for executor in ('thread', 'process'):
+            baseline = None
+
+            for workers in [int(x) for x in args.workers.split(',')]:
+                start = time.time()
+                queryset_to_list(Tag.objects.all(), workers=workers,
+                                 executor=executor, **template)
+                elapsed = time.time() - start
+                baseline = baseline or elapsed
+
+                print('{0:>8} {1:>3} workers: {2:7.3f}s ({3:.2f}x)'.format(
+                    executor, workers, elapsed, baseline / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""Benchmarks serializing instances, querysets and templates.
+
+Usage: python benchmarks/run.py [--rows 10000] [--repeat 3] [--only name]
+                                [--save file.json] [--compare file.json]
+
+Each case is timed (best of `--repeat`), and run once more to count the
+queries and measure the peak memory allocated. With `--compare`, cases
+that are slower than the baseline by more than `--threshold` or execute
+more queries are reported and the exit status is 1.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+import fixtures
+
+
+def posthook(instance, attrs):
+    attrs['path'] = '/libraries/{0}/'.format(instance.pk)
+    return attrs
+
+
+def get_cases(rows):
+    from django.contrib.auth.models import User
+    from tests.models import Tag, Library, Hacker
+    from preserialize.serialize import serialize, iter_serialize
+
+    def instances():
+        objects = list(Hacker.objects.select_related('user')[:1000])
+
+        for obj in objects:
+            serialize(obj)
+
+        return len(objects)
+
+    def queryset():
+        return len(serialize(Tag.objects.all()))
+
+    def stream():
+        return sum(1 for _ in iter_serialize(Tag.objects.all()))
+
+    def values_list():
+        return len(serialize(Tag.objects.all(), fields=['id', 'name'],
+                             values_list=True))
+
+    def nested():
+        return len(serialize(Hacker.objects.all(), fields=[
+            'user', 'website', 'libraries',
+        ], related={
+            'user': {'fields': ['username', 'email']},
+            'libraries': {'fields': ['name', 'tags'], 'related': {
+                'tags': {'fields': ['name', 'libraries'], 'related': {
+                    'libraries': {'fields': ['name']},
+                }},
+            }},
+        }))
+
+    def key_options():
+        return len(serialize(Library.objects.all(),
+                             fields=['id', 'name', 'url_path'],
+                             aliases={'url_path': 'url'},
+                             prefix='library_', camelcase=True))
+
+    def hooks():
+        return len(serialize(Library.objects.all(),
+                             fields=['name', 'language'], posthook=posthook))
+
+    def method():
+        return len(serialize(Hacker.objects.select_related('user'),
+                             fields=['signature']))
+
+    def users():
+        return len(serialize(User.objects.all()))
+
+    # All of the user's fields and a method, so instances are serialized
+    wide = {'fields': [':local', 'get_full_name'],
+            'exclude': ['password', 'groups', 'user_permissions']}
+
+    def wide_generic():
+        return len(serialize(User.objects.all(), **wide))
+
+    def wide_codegen():
+        return len(serialize(User.objects.all(), codegen=True, **wide))
+
+    return [
+        ('instances', instances),
+        ('queryset', queryset),
+        ('stream', stream),
+        ('values_list', values_list),
+        ('nested', nested),
+        ('key_options', key_options),
+        ('hooks', hooks),
+        ('method', method),
+        ('users', users),
+        ('wide_generic', wide_generic),
+        ('wide_codegen', wide_codegen),
+    ]
+
+
+def measure(func, repeat):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    seconds = None
+
+    for _ in range(repeat):
+        start = time.time()
+        count = func()
+        elapsed = time.time() - start
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    with CaptureQueriesContext(connection) as ctx:
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'objects': count,
+        'seconds': seconds,
+        'throughput': count / seconds if seconds else None,
+        'queries': len(ctx),
+        'peak_memory': peak,
+    }
+
+
+def compare(results, baseline, threshold):
+    "Returns the descriptions of the regressions from the baseline."
+    regressions = []
+
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+
+        base = baseline[name]
+
+        if result['seconds'] > base['seconds'] * (1 + threshold):
+            regressions.append('{0}: {1:.3f}s, baseline {2:.3f}s'.format(
+                name, result['seconds'], base['seconds']))
+
+        if result['queries'] > base['queries']:
+            regressions.append('{0}: {1} queries, baseline {2}'.format(
+                name, result['queries'], base['queries']))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', action='append')
+    parser.add_argument('--save')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        fixtures.setup(os.path.join(directory, 'db'))
+        fixtures.generate(args.rows)
+
+        results = {}
+        print('{0:<12} {1:>8} {2:>10} {3:>12} {4:>8} {5:>10}'.format(
+            'case', 'objects', 'seconds', 'objects/s', 'queries', 'peak KB'))
+
+        for name, func in get_cases(args.rows):
+            if args.only and name not in args.only:
+                continue
+
+            result = results[name] = measure(func, args.repeat)
+            print('{0:<12} {1[objects]:>8} {1[seconds]:>10.4f} '
+                  '{1[throughput]:>12.0f} {1[queries]:>8} {2:>10.0f}'
+                  .format(name, result, result['peak_memory'] / 1024.0))
+    finally:
+        shutil.rmtree(directory)
+
+    data = {'rows': args.rows, 'results': results}
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if baseline['rows'] != args.rows:
+            print('The baseline was run with {0} rows'.format(
+                baseline['rows']))
+
+        regressions = compare(results, baseline['results'], args.threshold)
+
+        for regression in regressions:
+            print('Regression: ' + regression)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
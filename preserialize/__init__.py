@@ -17,3 +17,6 @@ def get_version(short=False):
 
 
 __version__ = get_version()
+
+
+default_app_config = 'preserialize.apps.PreserializeConfig'
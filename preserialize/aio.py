@@ -0,0 +1,215 @@
+"""Serialization for async code. Requires Python 3.6 or later.
+
+Everything that may query the database (reading a chunk of rows,
+prefetching its related objects and serializing its objects) runs in a
+dedicated thread, so the event loop is not blocked. The thread keeps its
+own database connection and queries are run one at a time, in the order
+they are awaited. Control is returned to the event loop after every chunk.
+"""
+import asyncio
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.db import models, close_old_connections
+from django.db.models.query import QuerySet
+from .serialize import Serializer, compile, _merge, _iterator, CHUNK_SIZE
+
+_executor = None
+_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    1, thread_name_prefix='preserialize')
+
+    return _executor
+
+
+async def _run(func, *args):
+    "Calls a function that may query the database in the database thread."
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_get_executor(), func, *args)
+
+
+async def _resolve(value):
+    "Awaits the value returned by a hook if it is awaitable."
+    if inspect.isawaitable(value):
+        return await value
+
+    return value
+
+
+def _to_dict(plan, instance):
+    close_old_connections()
+    return plan.to_dict(instance)
+
+
+def _take(iterator, size):
+    return [x for _, x in zip(range(size), iterator)]
+
+
+async def _chunks(queryset, chunk_size):
+    "Yields lists of up to `chunk_size` rows of the queryset."
+    # Connections that are unusable or past their maximum age are closed
+    # at the start of each queryset, as they are for each request
+    await _run(close_old_connections)
+
+    # The iterator is only advanced in the thread it was created in
+    iterator = await _run(_iterator, queryset, chunk_size)
+
+    while True:
+        chunk = await _run(_take, iterator, chunk_size)
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def _split_hooks(options):
+    """Removes the callable `prehook` and `posthook` from the options, so
+    they can be awaited if they are coroutines.
+    """
+    options = options.copy()
+    prehook = options.get('prehook')
+    posthook = options.pop('posthook', None) or None
+
+    if callable(prehook):
+        options.pop('prehook')
+    else:
+        prehook = None
+
+    return options, prehook, posthook
+
+
+class AsyncSerializer(Serializer):
+    """Same as `Serializer`, with coroutines for serializing objects in
+    async code.
+
+    The top-level `prehook` and `posthook` may be coroutine functions (or
+    return an awaitable). Hooks of related templates are called
+    synchronously.
+    """
+
+    async def aserialize(self, obj, fields=None, exclude=None,
+                         chunk_size=CHUNK_SIZE, **options):
+        "Same as `serialize`. Querysets are read in chunks of `chunk_size`."
+        options = _merge({}, self.options, options)
+
+        if isinstance(obj, QuerySet):
+            items = []
+
+            async for attrs in self.aiter_serialize(obj, fields, exclude,
+                                                    chunk_size, **options):
+                items.append(attrs)
+
+            return items
+
+        if isinstance(obj, models.Model):
+            options, prehook, posthook = _split_hooks(options)
+
+            if prehook is not None:
+                obj = await _resolve(prehook(obj))
+
+                if obj is None:
+                    return {}
+
+            plan = compile(obj.__class__, fields, exclude, **options)
+            attrs = await _run(_to_dict, plan, obj)
+
+            if posthook is not None:
+                attrs = await _resolve(posthook(obj, attrs))
+
+            return attrs
+
+        if isinstance(obj, dict):
+            return self.serialize(obj, fields, exclude, **options)
+
+        if hasattr(obj, '__iter__'):
+            return [await self.aserialize(x, fields, exclude, chunk_size,
+                                          **options) for x in obj]
+
+        return obj
+
+    async def aiter_serialize(self, obj, fields=None, exclude=None,
+                              chunk_size=CHUNK_SIZE, **options):
+        """Same as `iter_serialize`. Rows of a queryset are read in chunks of
+        `chunk_size` and the related objects are prefetched per chunk.
+        """
+        options = _merge({}, self.options, options)
+
+        if not isinstance(obj, QuerySet):
+            if hasattr(obj, '__iter__') and not isinstance(obj, dict):
+                for x in obj:
+                    yield await self.aserialize(x, fields, exclude,
+                                                chunk_size, **options)
+            else:
+                yield await self.aserialize(obj, fields, exclude, chunk_size,
+                                            **options)
+            return
+
+        options, prehook, posthook = _split_hooks(options)
+        plan = compile(obj.model, fields, exclude, **options)
+        queryset = obj
+
+        if plan.format != 'dicts' and not plan.options['values_list']:
+            raise ValueError('Querysets cannot be streamed in the "{0}" '
+                             'format'.format(plan.format))
+
+        if prehook is not None:
+            queryset = await _resolve(prehook(queryset))
+
+            if queryset is None:
+                return
+
+        # Dict prehooks and `select_related`
+        queryset = plan._filter(queryset)
+
+        if plan.options['values_list']:
+            async for chunk in _chunks(plan._values_list(queryset),
+                                       chunk_size):
+                for row in chunk:
+                    yield row
+                await asyncio.sleep(0)
+            return
+
+        # The posthook takes the model instances
+        columns = None
+
+        if plan._optimizes(queryset):
+            if posthook is None:
+                columns = plan._values_columns()
+
+            if columns is None:
+                queryset = plan._select(queryset)
+
+        if columns is not None:
+            lookups, columns = columns
+
+            async for chunk in _chunks(queryset.values_list(*lookups),
+                                       chunk_size):
+                for row in chunk:
+                    yield plan._values_row(row, columns)
+                await asyncio.sleep(0)
+            return
+
+        async for chunk in _chunks(queryset, chunk_size):
+            items = await _run(plan._chunk_to_list, chunk)
+
+            for instance, attrs in zip(chunk, items):
+                if posthook is not None:
+                    attrs = await _resolve(posthook(instance, attrs))
+                yield attrs
+
+            await asyncio.sleep(0)
+
+
+_serializer = AsyncSerializer()
+
+aserialize = _serializer.aserialize
+aiter_serialize = _serializer.aiter_serialize
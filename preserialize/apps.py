@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+from django.conf import settings
+from .utils import resolver
+
+
+class PreserializeConfig(AppConfig):
+    name = 'preserialize'
+    verbose_name = 'Preserialize'
+
+    def ready(self):
+        # Connects the signals that invalidate cached objects
+        from . import cache  # noqa
+
+        # Resolve the fields of all models up front rather than on the
+        # first request that serializes each model
+        if getattr(settings, 'PRESERIALIZE_WARM_RESOLVER', True):
+            resolver.warm(self.apps.get_models())
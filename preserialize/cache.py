@@ -0,0 +1,281 @@
+import copy
+import uuid
+import hashlib
+import threading
+import collections
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from .utils import fingerprint
+
+KEY_PREFIX = 'preserialize'
+
+
+class LRUCache(object):
+    """An in-process, thread-safe least recently used cache implementing
+    the subset of Django's cache API used for serialized objects. Values are
+    copied (not pickled) when they are stored and read, so changing the
+    returned objects does not change the cache. Timeouts are ignored.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        found = {}
+
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    # Move to the end as the most recently used
+                    found[key] = self._data[key] = self._data.pop(key)
+
+        return copy.deepcopy(found)
+
+    def add(self, key, value, timeout=None):
+        with self._lock:
+            if key in self._data:
+                return False
+
+            self._set(key, value)
+            return True
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._set(key, value)
+
+    def set_many(self, mapping, timeout=None):
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key, value)
+
+        return []
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def _set(self, key, value):
+        self._data.pop(key, None)
+
+        while len(self._data) >= self.max_size:
+            self._data.popitem(last=False)
+
+        self._data[key] = copy.deepcopy(value)
+
+
+# Cache aliases and objects that have been used in this process. Changes to
+# models are invalidated in these and the `PRESERIALIZE_CACHE` alias.
+_aliases = set()
+_objects = []
+_lock = threading.Lock()
+
+
+def get_backend(cache):
+    """Returns the backend for the `cache` option: `True` for the
+    `PRESERIALIZE_CACHE` alias (or `'default'`), the alias of a cache in
+    `CACHES` or an object implementing the cache API, such as `LRUCache`.
+    """
+    if cache is True:
+        cache = getattr(settings, 'PRESERIALIZE_CACHE', None) or 'default'
+
+    if isinstance(cache, str):
+        if cache not in _aliases:
+            with _lock:
+                _aliases.add(cache)
+
+        return caches[cache]
+
+    if not any(x is cache for x in _objects):
+        with _lock:
+            _objects.append(cache)
+
+    return cache
+
+
+def _backends():
+    aliases = set(_aliases)
+
+    if getattr(settings, 'PRESERIALIZE_CACHE', None):
+        aliases.add(settings.PRESERIALIZE_CACHE)
+
+    return [caches[x] for x in aliases] + list(_objects)
+
+
+def _label(model):
+    opts = model._meta.concrete_model._meta
+    return '{0}.{1}'.format(opts.app_label, opts.model_name)
+
+
+def _model_version_key(model):
+    return '{0}:v:{1}'.format(KEY_PREFIX, _label(model))
+
+
+def _row_version_key(model, pk):
+    return '{0}:v:{1}:{2}'.format(KEY_PREFIX, _label(model), pk)
+
+
+def _versions(backend, keys):
+    versions = backend.get_many(keys)
+
+    for key in keys:
+        if key not in versions:
+            version = uuid.uuid4().hex
+
+            # If this fails the version was just changed. The version
+            # generated here is used for this call and not stored.
+            backend.add(key, version, None)
+            versions[key] = version
+
+    return versions
+
+
+class ResultCache(object):
+    """Caches the serialized objects of a plan by the template fingerprint,
+    model and primary key.
+
+    Each key includes a version of the object itself and a version of each
+    model related through the template. Saving or deleting an object (or
+    changing a many-to-many relation) replaces the object's version and its
+    model's version, so the object and any object that may include it in
+    its output are serialized again.
+    """
+
+    def __init__(self, plan):
+        self.plan = plan
+        self.cache = plan.options['cache']
+        self.timeout = plan.options.get('cache_timeout')
+        self._prefix = None
+        self._dependencies = None
+
+    def _keys(self, backend, instances):
+        if self._prefix is None:
+            self._prefix = '{0}:{1}:'.format(
+                KEY_PREFIX, fingerprint(self.plan.options))
+            self._dependencies = [_model_version_key(x) for x in
+                                  self.plan._related_models()]
+
+        rows = [_row_version_key(x.__class__, x.pk) for x in instances]
+        versions = _versions(backend, self._dependencies + rows)
+        related = ''.join([versions[x] for x in self._dependencies])
+        keys = []
+
+        for instance, row in zip(instances, rows):
+            digest = hashlib.md5((related + versions[row]).encode('utf-8'))
+            keys.append('{0}{1}:{2}:{3}'.format(
+                self._prefix, _label(instance.__class__), instance.pk,
+                digest.hexdigest()))
+
+        return keys
+
+    def to_list(self, instances, prefetch=True):
+        """Returns the serialized `instances`, only serializing (and
+        prefetching the related objects of) those that are not cached.
+        """
+        if not instances:
+            return []
+
+        backend = get_backend(self.cache)
+        keys = self._keys(backend, instances)
+        cached = backend.get_many(keys)
+
+        missing = [x for x, key in zip(instances, keys) if key not in cached]
+
+        if missing:
+            if prefetch:
+                self.plan._prefetch(missing)
+
+            missing_keys = [x for x in keys if x not in cached]
+            values = dict(zip(missing_keys, self.plan._serialize(missing)))
+
+            if self.timeout is None:
+                backend.set_many(values)
+            else:
+                backend.set_many(values, self.timeout)
+
+            cached.update(values)
+
+        return [cached[x] for x in keys]
+
+
+def invalidate(model, pks=()):
+    """Replaces the version of `model` and of the objects with the primary
+    keys `pks` in the caches, so they are serialized again.
+    """
+    backends = _backends()
+
+    if not backends:
+        return
+
+    versions = {}
+
+    for _model in [model] + list(model._meta.get_parent_list()):
+        versions[_model_version_key(_model)] = uuid.uuid4().hex
+
+        for pk in pks:
+            versions[_row_version_key(_model, pk)] = uuid.uuid4().hex
+
+    for backend in backends:
+        backend.set_many(versions, None)
+
+
+def _m2m_related_pks(sender, instance, reverse, model):
+    "Returns the primary keys of the objects related through `sender`."
+    if reverse:
+        fields = model._meta.many_to_many
+    else:
+        fields = instance._meta.many_to_many
+
+    for field in fields:
+        if field.remote_field.through is sender:
+            break
+    else:
+        return []
+
+    if reverse:
+        source, target = field.m2m_reverse_field_name(), \
+            field.m2m_field_name()
+    else:
+        source, target = field.m2m_field_name(), \
+            field.m2m_reverse_field_name()
+
+    return list(sender._default_manager.filter(**{source: instance.pk})
+                .values_list(target, flat=True))
+
+
+def _saved(sender, instance, **kwargs):
+    invalidate(sender, [instance.pk])
+
+
+def _m2m_changed(sender, instance, action, reverse, model, pk_set,
+                 **kwargs):
+    if action in ('post_add', 'post_remove'):
+        pks = pk_set or ()
+
+    # The related objects are looked up before they are cleared and
+    # invalidated again afterwards
+    elif action == 'pre_clear' and _backends():
+        pks = _m2m_related_pks(sender, instance, reverse, model)
+        instance.__dict__['_preserialize_cleared'] = pks
+    elif action == 'post_clear':
+        pks = instance.__dict__.pop('_preserialize_cleared', ())
+    else:
+        return
+
+    invalidate(instance.__class__, [instance.pk])
+    invalidate(model, pks)
+
+
+post_save.connect(_saved)
+post_delete.connect(_saved)
+m2m_changed.connect(_m2m_changed)
@@ -0,0 +1,108 @@
+"""Serialization of the objects of a queryset that changed since a
+checkpoint, for clients that keep a synchronized copy.
+
+Objects are changed if the `modified_field` of the object or of one of the
+related objects in the template is later than the checkpoint. Deleted
+objects are recorded by a model derived from `models.AbstractTombstone`
+(see `track_deletions`).
+"""
+from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .utils import encode_token, decode_token
+from .serialize import compile
+from .conditional import modified_lookups
+
+
+def encode_checkpoint(time):
+    "Returns the token of a checkpoint at `time`."
+    return encode_token({'time': time.isoformat()})
+
+
+def decode_checkpoint(token):
+    "Returns the time of a checkpoint. Raises `ValueError` if it is invalid."
+    data = decode_token(token)
+
+    try:
+        time = parse_datetime(data['time'])
+    except (KeyError, TypeError, ValueError):
+        time = None
+
+    if time is None:
+        raise ValueError('Invalid checkpoint "{0}"'.format(token))
+
+    return time
+
+
+def _label(model):
+    return model._meta.concrete_model._meta.label
+
+
+def track_deletions(model, tombstone):
+    """Records the deleted objects of `model` (and its subclasses) with the
+    `tombstone` model. Returns the receiver of the `post_delete` signal.
+    """
+    def receiver(sender, instance, **kwargs):
+        if issubclass(sender, model):
+            tombstone._default_manager.create(model=_label(sender),
+                                              object_pk=str(instance.pk))
+
+    post_delete.connect(receiver, weak=False)
+    return receiver
+
+
+def serialize_changes(queryset, since=None, modified_field='modified',
+                      tombstones=None, fields=None, exclude=None, **options):
+    """Serializes the objects of the queryset that changed since the
+    checkpoint `since`, or all of them if it is `None`. Returns a dict of
+    the serialized `changed` objects, the primary keys of the `deleted`
+    objects and the `checkpoint` token of the next call.
+
+    Deleted objects are read from the `tombstones` model, if given. Raises
+    `ValueError` if the checkpoint is invalid or no model in the template
+    has the `modified_field`.
+    """
+    model = queryset.model
+
+    # Changes made while the objects are read are included in the next call
+    checkpoint = timezone.now()
+
+    plan = compile(model, fields, exclude, **options)
+    lookups = modified_lookups(plan, modified_field)
+
+    if not lookups:
+        raise ValueError('No model in the template has the "{0}" field'
+                         .format(modified_field))
+
+    deleted = []
+
+    if since is not None:
+        time = decode_checkpoint(since)
+        query = Q()
+
+        for lookup in lookups:
+            query |= Q(**{lookup + '__gt': time})
+
+        # Selected by primary key, since joined relations repeat objects
+        queryset = queryset.filter(pk__in=model._default_manager.filter(
+            query).values('pk'))
+
+        if tombstones is not None:
+            pks = tombstones._default_manager.filter(
+                model=_label(model), deleted__gt=time,
+            ).values_list('object_pk', flat=True).distinct()
+
+            # The key of a one-to-one primary key, e.g. of a child model
+            field = model._meta.pk
+
+            while field.is_relation:
+                field = field.target_field
+
+            deleted = [field.to_python(x) for x in pks]
+
+    return {
+        'changed': plan.to_list(queryset),
+        'deleted': deleted,
+        'checkpoint': encode_checkpoint(checkpoint),
+    }
@@ -0,0 +1,193 @@
+"""Generates the Python source of a function that serializes an instance
+for a particular compiled plan.
+
+The generic `Plan._to_dict` loop checks each field's options and the type
+of its value for every object. The generated function has the output keys,
+accessors and the options of each field inlined, and calls the generated
+functions of related plans directly. The output is the same as the plan's.
+
+Generated functions are used by plans with the `codegen` option, and can be
+created for any plan with `function`. The source of a function is available
+as its `source` attribute.
+"""
+import re
+import keyword
+from django.db import models
+from django.db.models.query import QuerySet
+from .serialize import compile as compile_plan, _value_lookup
+
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def _inlines(plan):
+    """Returns true if `plan.to_dict` is the same as calling the plan's
+    generated function, i.e. there are no hooks or cache around it.
+    """
+    return isinstance(plan.model, type) and \
+        issubclass(plan.model, models.Model) and \
+        not plan.prehook and not plan.batch_prehook and \
+        not plan.batch_posthook and plan.cache is None and \
+        not plan.options['values_list']
+
+
+def _attribute(accessor):
+    "Returns true if the accessor can be written as an attribute."
+    return bool(_identifier.match(accessor)) and \
+        not keyword.iskeyword(accessor)
+
+
+def generate(plan, ancestors=()):
+    """Returns the source of the function for `plan` and the namespace it
+    is executed in.
+    """
+    ancestors = ancestors + (plan,)
+    namespace = {
+        'Model': models.Model,
+        'QuerySet': QuerySet,
+        'model': plan.model,
+        'fallback': plan._to_dict,
+    }
+    allow_missing = repr(plan.allow_missing)
+
+    lines = [
+        'def to_dict(instance):',
+        # Accessors are specific to the model, see `Plan._to_dict`
+        '    if instance.__class__ is not model:',
+        '        return fallback(instance)',
+        '    attrs = {}',
+    ]
+
+    if any(x.prefetch_attr for x in plan.fields):
+        lines.append('    values = instance.__dict__')
+
+    for i, field in enumerate(plan.fields):
+        key = repr(field.key)
+        namespace['field_%d' % i] = field
+        namespace['get_%d' % i] = field.get
+        indent = '    '
+
+        if field.prefetch_attr:
+            related = field.plan(field.relation.related_model)
+            objects = 'values[%r]' % field.prefetch_attr
+
+            if field.limit is not None:
+                objects += '[:%d]' % field.limit
+
+            lines.append('    if %r in values:' % field.prefetch_attr)
+
+            if _inlines(related) and related.format == 'dicts' and \
+                    related not in ancestors:
+                namespace['to_dict_%d' % i] = function(related, ancestors)
+                lines.append('        attrs[%s] = [to_dict_%d(x) for x in '
+                             '%s]' % (key, i, objects))
+            else:
+                namespace['plan_%d' % i] = related
+                lines.append('        attrs[%s] = plan_%d._format('
+                             'plan_%d._to_list(%s))' % (key, i, i, objects))
+
+            lines.append('    else:')
+            indent = '        '
+
+        prep = _value_lookup(plan.model, field.accessor)[1]
+
+        # Concrete fields are read and prepped directly
+        if prep is not None and _attribute(field.accessor):
+            namespace['prep_%d' % i] = prep
+            lines.append('%sattrs[%s] = prep_%d(instance.%s)'
+                         % (indent, key, i, field.accessor))
+            continue
+
+        lines.append('%svalue = get_%d(instance, %s)'
+                     % (indent, i, allow_missing))
+
+        relation = field.relation
+
+        # Reverse foreign keys and many-to-many relations are querysets
+        if relation is not None and (relation.one_to_many or
+                                     relation.many_to_many):
+            lines.append('%sattrs[%s] = field_%d.plan(value.model)'
+                         '.to_list(value)' % (indent, key, i))
+            continue
+
+        lines.append('%sif isinstance(value, Model):' % indent)
+
+        related = None
+
+        if relation is not None and relation.concrete:
+            related = field.plan(relation.related_model)
+
+            if not _inlines(related) or related in ancestors:
+                related = None
+
+        if related is not None:
+            namespace['related_%d' % i] = related.model
+            namespace['to_dict_%d' % i] = function(related, ancestors)
+            lines.append('%s    if value.__class__ is related_%d:'
+                         % (indent, i))
+            lines.append('%s        related = to_dict_%d(value)'
+                         % (indent, i))
+            lines.append('%s    else:' % indent)
+            lines.append('%s        related = field_%d.plan(value.__class__)'
+                         '.to_dict(value)' % (indent, i))
+        else:
+            lines.append('%s    related = field_%d.plan(value.__class__)'
+                         '.to_dict(value)' % (indent, i))
+
+        if field.flatten:
+            lines.append('%s    attrs[%s] = list(related.values())[0]'
+                         % (indent, key))
+        elif field.merge:
+            lines.append('%s    attrs.update(related)' % indent)
+        else:
+            lines.append('%s    attrs[%s] = related' % (indent, key))
+
+        # Foreign keys and one-to-one relations are objects or `None`
+        if relation is None:
+            lines.append('%selif isinstance(value, QuerySet):' % indent)
+            lines.append('%s    attrs[%s] = field_%d.plan(value.model)'
+                         '.to_list(value)' % (indent, key, i))
+
+        lines.append('%selse:' % indent)
+        lines.append('%s    attrs[%s] = value' % (indent, key))
+
+    if plan.aggregates:
+        namespace['aggregate'] = plan._aggregate
+        lines.append('    aggregate(instance, attrs)')
+
+    if plan.posthook:
+        namespace['posthook'] = plan.posthook
+        lines.append('    attrs = posthook(instance, attrs)')
+
+    lines.append('    return attrs')
+
+    return '\n'.join(lines) + '\n', namespace
+
+
+def function(plan, ancestors=()):
+    """Returns the generated function for `plan`, which takes an instance
+    and returns the same dict as `plan._to_dict`. The function is cached on
+    the plan.
+    """
+    if plan._function is not None:
+        return plan._function
+
+    # Plans of objects other than model instances are not generated
+    if not isinstance(plan.model, type) or \
+            not issubclass(plan.model, models.Model):
+        return plan._to_dict
+
+    source, namespace = generate(plan, ancestors)
+    exec(source, namespace)
+
+    func = namespace['to_dict']
+    func.source = source
+    plan._function = func
+
+    return func
+
+
+def compile(model, fields=None, exclude=None, **options):
+    """Compiles a template for `model` and returns its generated function
+    (see `serialize.compile`).
+    """
+    return function(compile_plan(model, fields, exclude, **options))
@@ -0,0 +1,136 @@
+"""Validators for conditional responses (`ETag` and `Last-Modified`) of
+serialized querysets, computed without serializing them.
+
+The validators are derived from one aggregate query: the number of
+objects, the greatest primary key and the latest modification time of the
+objects and the related objects in the template, read from the field named
+by `modified_field` on each model that has it. The `ETag` also depends on
+the template. At least one model must have the field, since changes to the
+objects in place are only detected by their modification time. Deleted
+related objects are not detected unless the parent object's modification
+time changes as well.
+"""
+import hashlib
+from django.db import models
+from django.views.decorators import http
+from .utils import fingerprint
+from .serialize import compile, _merge
+
+
+def _has_field(model, name):
+    try:
+        model._meta.get_field(name)
+    except models.FieldDoesNotExist:
+        return False
+
+    return True
+
+
+def modified_lookups(plan, modified_field, prefix='', ancestors=()):
+    """Returns the lookups of `modified_field` on the model of `plan` and
+    the models of the related objects in its template.
+    """
+    ancestors = ancestors + (plan,)
+    lookups = []
+
+    if _has_field(plan.model, modified_field):
+        lookups.append(prefix + modified_field)
+
+    for field in plan.fields:
+        if field.relation is None:
+            continue
+
+        related = field.plan(field.relation.related_model)
+
+        if related not in ancestors:
+            lookups.extend(modified_lookups(
+                related, modified_field, prefix + field.accessor + '__',
+                ancestors))
+
+    return lookups
+
+
+def validators(queryset, modified_field, fields=None, exclude=None,
+               **options):
+    """Returns the `ETag` and the `Last-Modified` time of the queryset
+    serialized with the template. The time is `None` if none of the objects
+    have a modification time. Raises `ValueError` if no model in the
+    template has the `modified_field`.
+    """
+    plan = compile(queryset.model, fields, exclude, **options)
+    lookups = []
+
+    if modified_field:
+        lookups = modified_lookups(plan, modified_field)
+
+    if not lookups:
+        raise ValueError('No model in the template has the "{0}" field'
+                         .format(modified_field))
+
+    # The objects are filtered by the prehook, but not annotated with the
+    # template's aggregates
+    options = _merge({}, options, {'aggregates': {}})
+    queryset = compile(plan.model, fields, exclude, **options)._filter(
+        queryset)
+
+    if queryset is None:
+        queryset = plan.model._default_manager.none()
+
+    # Joined relations repeat the objects, which does not change the
+    # greatest values
+    aggregates = {
+        'count': models.Count('pk', distinct=True),
+        'pk': models.Max('pk'),
+    }
+
+    for i, lookup in enumerate(lookups):
+        aggregates['modified_%d' % i] = models.Max(lookup)
+
+    if queryset.query.can_filter():
+        queryset = queryset.order_by()
+
+    values = queryset.aggregate(**aggregates)
+
+    modified = [values['modified_%d' % i] for i in range(len(lookups))]
+    modified = [x for x in modified if x is not None]
+    last_modified = max(modified) if modified else None
+
+    # Templates with hooks that cannot be imported are only identified
+    # within the process
+    try:
+        template = fingerprint(plan.options)
+    except ValueError:
+        template = fingerprint(plan.options, 'identity')
+
+    digest = hashlib.sha1()
+
+    for value in (template, values['count'], values['pk'], last_modified):
+        digest.update(repr(value).encode('utf-8'))
+
+    return digest.hexdigest(), last_modified
+
+
+def condition(get_queryset, modified_field, fields=None, exclude=None,
+              **options):
+    """Returns a view decorator that answers conditional requests with the
+    validators of the queryset returned by `get_queryset`, which is called
+    with the view's arguments (see `django.views.decorators.http.condition`).
+    The validators are computed once per request.
+    """
+    def get(request, *args, **kwargs):
+        computed = request.__dict__.setdefault('_preserialize_validators', {})
+
+        if get not in computed:
+            computed[get] = validators(get_queryset(request, *args, **kwargs),
+                                       modified_field, fields, exclude,
+                                       **options)
+
+        return computed[get]
+
+    def etag(request, *args, **kwargs):
+        return get(request, *args, **kwargs)[0]
+
+    def last_modified(request, *args, **kwargs):
+        return get(request, *args, **kwargs)[1]
+
+    return http.condition(etag_func=etag, last_modified_func=last_modified)
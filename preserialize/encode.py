@@ -0,0 +1,153 @@
+import io
+import uuid
+import decimal
+import datetime
+from django.core.serializers.json import DjangoJSONEncoder
+from .serialize import Serializer, CHUNK_SIZE
+
+# Encoded output is yielded once it reaches this many characters
+BUFFER_SIZE = 64 * 1024
+
+
+def _isoformat(o):
+    return o.isoformat()
+
+
+class JSONEncoder(DjangoJSONEncoder):
+    """JSON encoder for serialized data. The types produced by the model
+    fields' `get_prep_value` are looked up by type before falling back to
+    Django's encoder, which handles subclasses, times and lazy strings.
+    """
+
+    encoders = {
+        decimal.Decimal: str,
+        uuid.UUID: str,
+        datetime.date: _isoformat,
+    }
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('separators', (',', ':'))
+        super(JSONEncoder, self).__init__(*args, **kwargs)
+
+    def default(self, o):
+        encoder = self.encoders.get(o.__class__)
+
+        if encoder is not None:
+            return encoder(o)
+
+        return super(JSONEncoder, self).default(o)
+
+
+class Encoder(object):
+    """Serializes objects and encodes them as JSON in a single pass.
+
+    Querysets are serialized with `Serializer.iter_serialize`, so each
+    object is encoded as soon as it is serialized and only the current
+    chunk of rows and the output buffer are held in memory.
+    """
+
+    def __init__(self, serializer=None, encoder=JSONEncoder,
+                 buffer_size=BUFFER_SIZE, encoding='utf-8', **options):
+        self.serializer = serializer or Serializer()
+        self.encoder = encoder(**options)
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+
+    def _items(self, obj, fields, exclude, chunk_size, options):
+        return self.serializer.iter_serialize(obj, fields, exclude,
+                                              chunk_size, **options)
+
+    def _buffer(self, chunks):
+        buffer = []
+        size = 0
+
+        for chunk in chunks:
+            buffer.append(chunk)
+            size += len(chunk)
+
+            if size >= self.buffer_size:
+                yield self._join(buffer)
+                buffer = []
+                size = 0
+
+        if buffer:
+            yield self._join(buffer)
+
+    def _join(self, buffer):
+        data = ''.join(buffer)
+
+        if self.encoding:
+            return data.encode(self.encoding)
+
+        return data
+
+    def _is_sequence(self, obj):
+        return hasattr(obj, '__iter__') and not isinstance(obj, dict)
+
+    def iter_json(self, obj, fields=None, exclude=None, chunk_size=CHUNK_SIZE,
+                  **options):
+        """Yields the JSON encoded output of `serialize(obj, ...)` in
+        chunks of at least `buffer_size` characters. Querysets are streamed,
+        so they must use the `'dicts'` format (see `Plan.iterate`).
+        """
+        encode = self.encoder.encode
+
+        def chunks():
+            if not self._is_sequence(obj):
+                yield encode(self.serializer.serialize(obj, fields, exclude,
+                                                       **options))
+                return
+
+            separator = '['
+
+            for item in self._items(obj, fields, exclude, chunk_size,
+                                    options):
+                yield separator
+                yield encode(item)
+                separator = ','
+
+            yield '[]' if separator == '[' else ']'
+
+        return self._buffer(chunks())
+
+    def iter_ndjson(self, obj, fields=None, exclude=None,
+                    chunk_size=CHUNK_SIZE, **options):
+        """Yields the serialized items as newline-delimited JSON in chunks
+        of at least `buffer_size` characters.
+        """
+        encode = self.encoder.encode
+
+        def chunks():
+            for item in self._items(obj, fields, exclude, chunk_size,
+                                    options):
+                yield encode(item)
+                yield '\n'
+
+        return self._buffer(chunks())
+
+    def dump(self, obj, fp, fields=None, exclude=None, ndjson=False,
+             chunk_size=CHUNK_SIZE, **options):
+        """Writes the encoded output to the file-like object `fp`. Text
+        files are written strings, any other file is written bytes.
+        """
+        if ndjson:
+            chunks = self.iter_ndjson(obj, fields, exclude, chunk_size,
+                                      **options)
+        else:
+            chunks = self.iter_json(obj, fields, exclude, chunk_size,
+                                    **options)
+
+        text = isinstance(fp, io.TextIOBase)
+
+        for chunk in chunks:
+            if text and isinstance(chunk, bytes):
+                chunk = chunk.decode(self.encoding)
+
+            fp.write(chunk)
+
+
+_encoder = Encoder()
+
+iter_json = _encoder.iter_json
+iter_ndjson = _encoder.iter_ndjson
+dump = _encoder.dump
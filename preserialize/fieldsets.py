@@ -0,0 +1,113 @@
+"""Sparse fieldsets requested by clients, e.g. `?fields=name,tags.name`.
+
+A fieldset is intersected with the template of the server, which sets the
+fields (and related objects) a client may request. The pruned template only
+contains the requested fields, so relations that are not requested are not
+joined, prefetched or serialized and only the requested columns are
+loaded.
+"""
+import re
+from .utils import parse_selectors, resolver
+from .template import Template
+
+_name = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def parse(expression):
+    """Parses a comma-separated list of dotted paths into a tree of dicts,
+    e.g. `'name,tags.name'` into `{'name': {}, 'tags': {'name': {}}}`. An
+    empty dict stands for all of the fields of a related object. Raises
+    `ValueError` if a path is not valid.
+    """
+    if isinstance(expression, (list, tuple)):
+        paths = expression
+    else:
+        paths = expression.split(',')
+
+    tree = {}
+
+    for path in paths:
+        path = path.strip()
+
+        if not path:
+            continue
+
+        names = path.split('.')
+
+        if not all(_name.match(x) for x in names):
+            raise ValueError('Invalid field "{0}"'.format(path))
+
+        node = tree
+
+        for name in names:
+            node = node.setdefault(name, {})
+
+    return tree
+
+
+def _replace(template, **options):
+    if isinstance(template, Template):
+        return template.copy(**options)
+
+    return dict(template, **options)
+
+
+def _prune(model, template, tree, prefix):
+    aliases = template.get('aliases') or {}
+    related = template.get('related') or {}
+    aggregates = template.get('aggregates') or {}
+    fields = parse_selectors(model, template.get('fields'),
+                             template.get('exclude'))
+
+    for name, children in tree.items():
+        if name not in fields and (children or name not in aggregates):
+            raise ValueError('The field "{0}{1}" is not allowed'.format(
+                prefix, name))
+
+    _related = {}
+
+    for alias in fields:
+        if alias not in tree:
+            continue
+
+        accessor = aliases.get(alias, alias)
+        children = tree[alias]
+
+        # The whole related template unless some of its fields are listed
+        if not children:
+            if accessor in related:
+                _related[accessor] = related[accessor]
+            continue
+
+        relation = resolver.get_relation(model, accessor)
+
+        if relation is None:
+            raise ValueError('The field "{0}{1}" has no fields'.format(
+                prefix, alias))
+
+        _related[accessor] = _prune(relation.related_model,
+                                    related.get(accessor, {}), children,
+                                    prefix + alias + '.')
+
+    # The fields that are not requested are excluded rather than listing
+    # the requested ones, which would select the default fields if none
+    # are requested
+    exclude = list(template.get('exclude') or ())
+    exclude.extend(x for x in fields if x not in tree and x not in exclude)
+
+    return _replace(template,
+                    exclude=exclude,
+                    related=_related,
+                    aggregates=dict((k, v) for k, v in aggregates.items()
+                                    if k in tree))
+
+
+def prune(model, template, expression):
+    """Returns a copy of the template of `model` with only the fields in
+    the fieldset `expression` (see `parse`). Fields of related objects are
+    listed by their path, e.g. `tags.name`, and a related field without a
+    path includes all of the fields of its template.
+
+    Raises `ValueError` if a field is not in the template.
+    """
+    return _prune(model, template, parse(expression), '')
@@ -0,0 +1,14 @@
+from django.db import models
+from django.utils import timezone
+
+
+class AbstractTombstone(models.Model):
+    """Records the deletion of an object, so clients that synchronize
+    serialized objects can remove it (see `changes.serialize_changes`).
+    """
+    model = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=100)
+    deleted = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta(object):
+        abstract = True
@@ -0,0 +1,131 @@
+"""Keyset pagination of serialized querysets.
+
+Rather than skipping rows with `OFFSET`, each page is selected by filtering
+on the ordering values of the last row of the previous page, so every page
+costs the same as the first one given an index on the ordering columns.
+"""
+import datetime
+import operator
+from functools import reduce
+from django.db.models import Q
+from .utils import encode_token, decode_token, get_model_field
+from .serialize import compile, _merge
+
+PAGE_SIZE = 100
+
+
+def _ordering(queryset, ordering):
+    "Returns the ordering with the primary key added to make it unique."
+    if ordering is None:
+        ordering = queryset.query.order_by or queryset.model._meta.ordering
+
+    ordering = list(ordering)
+
+    for name in ordering:
+        if not isinstance(name, str) or name.startswith('?'):
+            raise ValueError('Only field names can be used to paginate')
+
+    names = ('pk', queryset.model._meta.pk.name)
+
+    if not any(x.lstrip('-') in names for x in ordering):
+        # Follow the direction of the last field
+        if ordering and ordering[-1].startswith('-'):
+            ordering.append('-pk')
+        else:
+            ordering.append('pk')
+
+    return ordering
+
+
+def _seek(ordering, values):
+    "Returns the filter for the rows after `values` in the `ordering`."
+    clauses = []
+
+    for i, name in enumerate(ordering):
+        lookup = name.lstrip('-') + ('__lt' if name.startswith('-')
+                                     else '__gt')
+        filters = dict((x.lstrip('-'), v) for x, v in
+                       zip(ordering[:i], values[:i]))
+        filters[lookup] = values[i]
+        clauses.append(Q(**filters))
+
+    return reduce(operator.or_, clauses)
+
+
+def _encode_value(value):
+    # The JSON encoder truncates times to milliseconds, which would skip or
+    # repeat rows that only differ in microseconds
+    if isinstance(value, (datetime.datetime, datetime.time)):
+        return value.isoformat()
+
+    return value
+
+
+def encode_cursor(ordering, values):
+    return encode_token({'ordering': ordering,
+                         'values': [_encode_value(x) for x in values]})
+
+
+def decode_cursor(model, cursor, ordering):
+    """Returns the ordering values of a cursor. Raises `ValueError` if the
+    cursor is invalid or was created for a different ordering.
+    """
+    data = decode_token(cursor)
+
+    if not isinstance(data, dict) or data.get('ordering') != ordering or \
+            len(data.get('values') or ()) != len(ordering):
+        raise ValueError('The cursor does not match the ordering')
+
+    return [get_model_field(model, x.lstrip('-')).to_python(v)
+            for x, v in zip(ordering, data['values'])]
+
+
+def paginate_serialize(queryset, cursor=None, page_size=PAGE_SIZE,
+                       ordering=None, fields=None, exclude=None, **options):
+    """Serializes a page of `page_size` objects of the queryset with the
+    template and returns a dict of the `results` and the `next` cursor,
+    which is `None` for the last page.
+
+    The objects are ordered by `ordering` (the queryset's ordering by
+    default), followed by the primary key if it is not included. Fields in
+    the ordering must not be null.
+    """
+    model = queryset.model
+    ordering = _ordering(queryset, ordering)
+
+    # The page is ordered and limited by the pagination
+    options = _merge({}, options, {'ordering': None, 'limit': None})
+    plan = compile(model, fields, exclude, **options)
+    queryset = plan._filter(queryset)
+
+    if queryset is None:
+        return {'results': plan._format([]), 'next': None}
+
+    queryset = queryset.order_by(*ordering)
+
+    if cursor is not None:
+        values = decode_cursor(model, cursor, ordering)
+        queryset = queryset.filter(_seek(ordering, values))
+
+    # The keys of the page are selected first, so the page is serialized
+    # with the same optimizations as any other queryset
+    names = [x.lstrip('-') for x in ordering]
+    rows = list(queryset.values_list(*names)[:page_size + 1])
+    pk_index = [i for i, x in enumerate(names)
+                if x in ('pk', model._meta.pk.name)][0]
+
+    if not rows:
+        return {'results': plan._format([]), 'next': None}
+
+    next_cursor = None
+
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(ordering, list(rows[-1]))
+
+    # The prehook has been applied to the queryset
+    plan = compile(model, fields, exclude,
+                   **_merge({}, options, {'prehook': False}))
+    page = queryset.filter(pk__in=[x[pk_index] for x in rows])
+
+    return {'results': plan.to_list(page), 'next': next_cursor}
@@ -0,0 +1,127 @@
+"""Serializes a queryset in a pool of threads or processes.
+
+The queryset is split into partitions of consecutive rows which are
+serialized by the workers, and the output is joined in the order of the
+queryset. This helps when serialization is CPU-bound, e.g. methods or
+posthooks that do a lot of work per object. Threads are limited by the
+GIL, but overlap the time spent waiting on the database; processes each
+open their own database connection.
+"""
+import itertools
+import django
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from django.apps import apps
+from django.db import connections
+from .serialize import queryset_to_list, _merge, _plan
+
+EXECUTORS = ('thread', 'process')
+
+
+def _ordered_by_pk(queryset):
+    ordering = list(queryset.query.order_by)
+
+    if not ordering and queryset.query.default_ordering:
+        ordering = list(queryset.model._meta.ordering)
+
+    names = ('pk', queryset.model._meta.pk.name)
+    return len(ordering) == 1 and ordering[0].lstrip('-') in names
+
+
+def partition(queryset, count):
+    """Splits the queryset into up to `count` querysets of consecutive rows.
+    Querysets ordered by primary key are split into primary key ranges and
+    any other ordering into lists of primary keys. Unordered querysets are
+    ordered by primary key.
+    """
+    if not queryset.ordered:
+        queryset = queryset.order_by('pk')
+
+    pks = list(queryset.values_list('pk', flat=True))
+
+    if not pks:
+        return []
+
+    size = -(-len(pks) // count)
+    chunks = [pks[i:i + size] for i in range(0, len(pks), size)]
+
+    if _ordered_by_pk(queryset):
+        return [queryset.filter(pk__gte=min(x), pk__lte=max(x))
+                for x in chunks]
+
+    return [queryset.filter(pk__in=x) for x in chunks]
+
+
+def _init_process():
+    # Processes that are spawned rather than forked start without setup
+    if not apps.ready:
+        django.setup()
+
+
+def _serialize(task):
+    model, db, query, options = task
+
+    # Querysets are evaluated when pickled, so they are sent as the query
+    queryset = model._default_manager.using(db).all()
+    queryset.query = query
+
+    return queryset_to_list(queryset, **options)
+
+
+def _serialize_in_thread(task):
+    try:
+        return _serialize(task)
+    finally:
+        # Each thread opens its own connection
+        connections.close_all()
+
+
+def parallel_to_list(queryset, workers, executor='thread', **options):
+    """Takes a queryset and converts it into a list of dicts using `workers`
+    threads or processes, depending on `executor`. Querysets are serialized
+    in the calling thread within a transaction.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError('The executor must be one of {0}'.format(EXECUTORS))
+
+    plan = _plan(queryset.model, options)
+    queryset = plan._filter(queryset)
+
+    if queryset is None:
+        return []
+
+    # The prehook has been applied to the queryset as a whole
+    options = _merge({}, options, {'prehook': False})
+
+    # Sliced querysets cannot be filtered into partitions, and the
+    # connections of the workers cannot see the changes of a transaction
+    # (nor can the caller's connection be closed during one)
+    if workers < 2 or not queryset.query.can_filter() or \
+            connections[queryset.db].in_atomic_block:
+        return queryset_to_list(queryset, **options)
+
+    partitions = partition(queryset, workers)
+
+    if len(partitions) < 2:
+        return queryset_to_list(queryset, **options)
+
+    # The partitions are formatted once joined
+    tasks = [(x.model, x.db, x.query, _merge({}, options, {'format': 'dicts'}))
+             for x in partitions]
+
+    if executor == 'process':
+        # Forked processes must not share the parent's connections
+        connections.close_all()
+        pool = Pool(workers, _init_process)
+        func = _serialize
+    else:
+        pool = ThreadPool(workers)
+        func = _serialize_in_thread
+
+    try:
+        results = pool.map(func, tasks)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return plan._format(list(itertools.chain.from_iterable(results)))
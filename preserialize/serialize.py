@@ -1,9 +1,15 @@
 import warnings
+import itertools
+import threading
+import contextlib
 import collections
-from django.db import models
+import django
+from django.db import models, connections
 from django.conf import settings
 from django.db.models.query import QuerySet
-from .utils import get_field_value, parse_selectors, convert_to_camel
+from .utils import get_field_value, parse_selectors, transform_key, \
+    resolver
+from .cache import ResultCache
 
 PRESERIALIZE_OPTIONS = getattr(settings, 'PRESERIALIZE_OPTIONS', {})
 
@@ -11,6 +17,7 @@ DEFAULT_OPTIONS = {
     'aliases': {},
     'allow_missing': False,
     'camelcase': False,
+    'key_transform': None,
     'prefix': '',
     'process': None,
     'values_list': False,
@@ -18,6 +25,16 @@ DEFAULT_OPTIONS = {
     'merge': False,
     'prehook': False,
     'posthook': False,
+    'batch_prehook': None,
+    'batch_posthook': None,
+    'aggregates': {},
+    'requires': None,
+    'format': 'dicts',
+    'ordering': None,
+    'limit': None,
+    'optimize': True,
+    'cache': False,
+    'codegen': False,
 }
 
 
@@ -56,123 +73,1395 @@ def _defaults(options):
     return defaults
 
 
-def model_to_dict(instance, **options):
-    "Takes a model instance and converts it into a dict."
+def _freeze(value, parents=()):
+    """Returns a hashable representation of a template value. Raises
+    `TypeError` if the value (or a nested value) cannot be hashed.
+
+    Recursive templates (e.g. the template of a foreign key to self that is
+    the template itself) are represented by a reference to the level of the
+    containing value, so equal recursive templates have the same key.
+    """
+    if isinstance(value, (dict, list, tuple, set)):
+        for level, parent in enumerate(parents):
+            if parent is value:
+                return (_freeze, level)
+
+        parents = parents + (value,)
+
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((k, _freeze(v, parents))
+                                   for k, v in value.items())))
+
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(_freeze(x, parents) for x in value))
+
+    if isinstance(value, set):
+        return frozenset(_freeze(x, parents) for x in value)
+
+    hash(value)
+    return value
+
+
+# Compiled plans keyed by model and frozen template. Templates containing
+# per-request callables (e.g. `partial` hooks) produce a new key each time,
+# so the cache is simply reset once it reaches the limit.
+PLAN_CACHE_SIZE = 512
+
+_plans = {}
+
+
+def _cached_plan(key, factory):
+    if key is not None:
+        plan = _plans.get(key)
+
+        if plan is not None:
+            return plan
+
+    plan = factory()
+
+    if key is not None:
+        if len(_plans) >= PLAN_CACHE_SIZE:
+            _plans.clear()
+
+        _plans[key] = plan
+
+    return plan
+
+
+def _clear_plans(model):
+    # Plans reference the resolved fields of any model in the template
+    _plans.clear()
+
+
+resolver.listeners.append(_clear_plans)
+
+
+def _plan(model, options):
+    "Returns a cached plan for `options` whose `fields` are already resolved."
+    try:
+        key = (model, _freeze(options))
+    except TypeError:
+        key = None
+
+    return _cached_plan(key, lambda: Plan(model, options))
+
+
+def compile(model, fields=None, exclude=None, **options):
+    """Compiles a template into a `Plan` for `model`.
+
+    The `fields` and `exclude` selectors are resolved against the model
+    and all options are defaulted once. The plan is cached by model and
+    template so subsequent calls with an equal template are a lookup.
+    """
+    # Related templates are compiled with the defaults, so a recursive
+    # template is compiled into the same plan at every level
+    try:
+        key = ('compile', model, _freeze(fields), _freeze(exclude),
+               _freeze(_merge({}, DEFAULT_OPTIONS, PRESERIALIZE_OPTIONS,
+                              options)))
+    except TypeError:
+        key = None
+
+    def factory():
+        _fields = parse_selectors(model, fields, exclude, **options)
+        return _plan(model, _merge({}, options, {'fields': _fields}))
+
+    return _cached_plan(key, factory)
+
+
+_unset = object()
+
+# The number of rows read and prefetched at a time when streaming
+CHUNK_SIZE = 2000
+
+
+def _iterator(queryset, chunk_size):
+    "Returns an iterator over the queryset that does not cache the results."
+    if django.VERSION >= (2, 0):
+        return queryset.iterator(chunk_size=chunk_size)
+
+    return queryset.iterator()
+
+
+# Unique suffixes for the attributes prefetched objects are stored under
+_prefetch_ids = itertools.count()
+
+
+class IdentityMap(object):
+    """The objects serialized by one `serialize` call, keyed by plan, model
+    and primary key. An object that occurs more than once in the output is
+    serialized once and its dict is reused.
+
+    If `normalize` is true, related objects are output as their primary
+    key and their dicts are collected in `included`, keyed by model label
+    and primary key.
+    """
+
+    def __init__(self, normalize=False):
+        self.normalize = normalize
+        self.objects = {}
+        self.included = {}
+
+    def include(self, model, pk, attrs):
+        "Adds the dict of a related object and returns its reference."
+        objects = self.included.setdefault(model._meta.label, {})
+        existing = objects.get(pk)
+
+        # The same object may be serialized by different templates
+        if existing is None:
+            objects[pk] = attrs
+        elif existing is not attrs:
+            objects[pk] = _merge({}, existing, attrs)
+
+        return pk
+
+
+_local = threading.local()
+
+
+def _identity_map():
+    return getattr(_local, 'identity', None)
 
-    options = _defaults(options)
-    attrs = {}
 
-    if options['prehook']:
+@contextlib.contextmanager
+def identity_map(normalize=False):
+    """Serializes each object once within the block (see `IdentityMap`).
+    Nested blocks use the outermost map.
+    """
+    identity = _identity_map()
+
+    if identity is not None:
+        yield identity
+        return
+
+    identity = _local.identity = IdentityMap(normalize)
+
+    try:
+        yield identity
+    finally:
+        _local.identity = None
+
+
+class FieldPlan(object):
+    "The precomputed output key, accessor and related options of a field."
+
+    __slots__ = ('alias', 'accessor', 'key', 'related', 'relation',
+                 'prefetch_attr', 'limit', 'attname', 'flatten', 'merge',
+                 'get', '_plans')
+
+    def __init__(self, alias, accessor, key, related, relation=None,
+                 get=None):
+        self.alias = alias
+        self.accessor = accessor
+        self.key = key
+        self.related = related
+
+        # Gets the value from an instance of the plan's model
+        self.get = get
+
+        # The model field or reverse relation if the accessor is relational
+        self.relation = relation
+
+        # Reverse foreign keys and many-to-many relations are prefetched
+        # into this attribute. It is unique to the field so objects
+        # prefetched for one template are never used by another.
+        if relation is not None and (relation.one_to_many or
+                                     relation.many_to_many):
+            self.prefetch_attr = '_preserialize_{0}_{1}'.format(
+                accessor, next(_prefetch_ids))
+        else:
+            self.prefetch_attr = None
+
+        # Prefetched objects are limited per parent by the prefetch query
+        # where the database supports it (see `Plan._related_queryset`) and
+        # when they are serialized
+        if self.prefetch_attr:
+            self.limit = related['limit']
+        else:
+            self.limit = None
+
+        # The key of a local foreign key, which identifies the related
+        # object without fetching it
+        if relation is not None and relation.concrete and \
+                not relation.many_to_many and \
+                relation.target_field.primary_key:
+            self.attname = relation.attname
+        else:
+            self.attname = None
+
+        # A related model instance with a single field is represented by
+        # that field's value, unless it is being merged into the parent
+        self.flatten = len(related['fields']) == 1 and related['flat'] \
+            and not related['merge']
+        self.merge = related['merge']
+
+        self._plans = {}
+
+    def plan(self, model):
+        "Returns the plan for a related object of type `model`."
+        plan = self._plans.get(model)
+
+        if plan is None:
+            options = self.related.copy()
+            fields = options.pop('fields', None)
+            exclude = options.pop('exclude', None)
+            plan = compile(model, fields, exclude, **options)
+            self._plans[model] = plan
+
+        return plan
+
+
+class Plan(object):
+    """A template compiled for a particular model.
+
+    All option handling (defaults, aliases, prefixes, key transforms and the
+    related sub-options) is done once when the plan is created rather than
+    for every serialized object. Plans should be treated as immutable.
+    """
+
+    __slots__ = ('model', 'options', 'fields', 'prehook', 'posthook',
+                 'batch_prehook', 'batch_posthook', 'allow_missing',
+                 'aggregates', 'values_attrs', 'cache', 'format', 'keys',
+                 '_columns', '_only_names', '_function')
+
+    def __init__(self, model, options):
+        options = _defaults(options.copy())
+
+        self.model = model
+        self.options = options
+        self.allow_missing = options['allow_missing']
+        self.posthook = options['posthook']
+        self.batch_prehook = options['batch_prehook']
+        self.batch_posthook = options['batch_posthook']
+
+        # Only callable prehooks apply to individual objects
         if isinstance(options['prehook'], collections.Callable):
-            instance = options['prehook'](instance)
-            if instance is None:
-                return attrs
+            self.prehook = options['prehook']
+        else:
+            self.prehook = None
+
+        is_model = isinstance(model, type) and issubclass(model, models.Model)
+        fields = []
 
-    # Items in the `fields` list are the output aliases, not the raw
-    # accessors (field, method, property names)
-    for alias in options['fields']:
+        # `camelcase` is the same as the camel case transform
+        transform = options['key_transform']
 
-        # Get the accessor for the object
-        accessor = options['aliases'].get(alias, alias)
+        if transform is None and options['camelcase']:
+            transform = 'camel'
 
-        # Create the key that will be used in the output dict
-        key = options['prefix'] + alias
+        # Items in the `fields` list are the output aliases, not the raw
+        # accessors (field, method, property names)
+        for alias in options['fields']:
 
-        # Optionally camelcase the key
-        if options['camelcase']:
-            key = convert_to_camel(key)
+            # Get the accessor for the object
+            accessor = options['aliases'].get(alias, alias)
 
-        # Get the field value. Use the mapped value to the actually property or
-        # method name. `value` may be a number of things, so the various types
-        # are checked below.
-        value = get_field_value(instance, accessor,
-                                allow_missing=options['allow_missing'])
+            # Create the key that will be used in the output dict
+            key = transform_key(options['prefix'], alias, transform)
 
-        # Related objects, perform some checks on their options
-        if isinstance(value, (models.Model, QuerySet)):
-            _options = _defaults(options['related'].get(accessor, {}))
+            related = _defaults(dict(options['related'].get(accessor, {})))
 
             # If the `prefix` follows the below template, generate the
             # `prefix` for the related object
-            if '%(accessor)s' in _options['prefix']:
-                _options['prefix'] = _options['prefix'] % {'accessor': alias}
+            if '%(accessor)s' in related['prefix']:
+                related['prefix'] = related['prefix'] % {'accessor': alias}
+
+            if is_model:
+                relation = resolver.get_relation(model, accessor)
+                get = resolver.get_accessor(model, accessor)
+            else:
+                relation = None
+                get = None
+
+            fields.append(FieldPlan(alias, accessor, key, related, relation,
+                                    get))
+
+        self.fields = tuple(fields)
+
+        # The output key, annotation name and expression of each aggregate
+        self.aggregates = ()
+
+        if is_model and options['aggregates']:
+            self.aggregates = tuple(
+                (transform_key(options['prefix'], alias, transform),
+                 '_preserialize_' + alias,
+                 _aggregate_expression(model, spec))
+                for alias, spec in sorted(options['aggregates'].items()))
+
+        if options['format'] not in FORMATS:
+            raise ValueError('Unknown format "{0}"'.format(options['format']))
+
+        self.format = options['format']
+
+        # The keys of the output in order, or `None` if they depend on the
+        # objects, i.e. are added by hooks or merged objects
+        if self.posthook or self.batch_posthook or \
+                any(x.merge for x in self.fields):
+            self.keys = None
+        else:
+            self.keys = []
+
+            for key in [x.key for x in self.fields] + \
+                    [x[0] for x in self.aggregates]:
+                if key not in self.keys:
+                    self.keys.append(key)
+
+        # Attribute names used to build the `values_list` output from
+        # instances that have already been fetched
+        self.values_attrs = None
+
+        if is_model and options['values_list']:
+            self.values_attrs = _values_attrs(model, options['fields'])
+
+        if is_model and options['cache']:
+            self.cache = ResultCache(self)
+        else:
+            self.cache = None
+
+        # Resolved on first use since they depend on the related plans
+        self._columns = _unset
+        self._only_names = _unset
+
+        # The generated function of the `codegen` option (see `codegen`)
+        self._function = None
+
+    def _values_columns(self):
+        """Returns the `values_list` lookups and the output keys and prep
+        functions for each field, or `None` if the template requires model
+        instances.
+        """
+        if self._columns is _unset:
+            self._columns = self._get_values_columns()
+
+        return self._columns
+
+    def _get_values_columns(self):
+        if not isinstance(self.model, type) or \
+                not issubclass(self.model, models.Model):
+            return None
+
+        # Hooks take the model instances and cached objects are looked up
+        # by instance
+        if self.posthook or self.prehook or self.batch_prehook or \
+                self.batch_posthook or self.cache:
+            return None
+
+        lookups = []
+        columns = []
+
+        for field in self.fields:
+            lookup, prep = _value_lookup(self.model, field.accessor)
+
+            # Local foreign keys can be selected when they are flattened
+            # to a single field of the related object
+            if lookup is None and field.relation is not None and \
+                    field.relation.concrete and \
+                    not field.relation.many_to_many and field.flatten:
+                plan = field.plan(field.relation.related_model)
+
+                if len(plan.fields) == 1 and not plan.posthook \
+                        and not plan.prehook:
+                    lookup, prep = _value_lookup(plan.model,
+                                                 plan.fields[0].accessor)
+
+                    if lookup is not None:
+                        lookup = field.accessor + '__' + lookup
+
+            if lookup is None:
+                return None
+
+            if lookup not in lookups:
+                lookups.append(lookup)
+
+            columns.append((field.key, lookups.index(lookup), prep))
+
+        for key, name, _ in self.aggregates:
+            lookups.append(name)
+            columns.append((key, len(lookups) - 1, None))
+
+        # An empty `values_list` would select all of the columns
+        if not lookups:
+            lookups.append('pk')
+
+        return lookups, columns
+
+    def _lookups(self, prefix='', ancestors=()):
+        """Walks the relational fields of the template and returns the
+        `select_related` paths for forward relations and the `Prefetch`
+        lookups for reverse and many-to-many relations.
+        """
+        ancestors = ancestors + (self,)
+        seen = set()
+        select = []
+        prefetch = []
+
+        for field in self.fields:
+            relation = field.relation
+
+            # Selectors may resolve to the same accessor more than once,
+            # e.g. a primary key that is also a local foreign key
+            if relation is None or field.accessor in seen:
+                continue
+
+            seen.add(field.accessor)
+
+            plan = field.plan(relation.related_model)
+
+            # Recursive templates (e.g. a foreign key to self) are only
+            # planned for up to the first repetition
+            if plan in ancestors:
+                continue
+
+            path = prefix + field.accessor
+
+            if field.prefetch_attr:
+                # Prefetched objects are matched by their foreign key
+                if relation.one_to_many:
+                    queryset = plan._related_queryset(
+                        ancestors, relation, (relation.field.name,))
+                else:
+                    queryset = plan._related_queryset(ancestors, relation)
+
+                if queryset is not None:
+                    prefetch.append(models.Prefetch(
+                        path, queryset=queryset, to_attr=field.prefetch_attr))
+            else:
+                select.append(path)
+                _select, _prefetch = plan._lookups(path + '__', ancestors)
+                select.extend(_select)
+                prefetch.extend(_prefetch)
+
+        return select, prefetch
+
+    def _related_models(self, ancestors=()):
+        "Returns the models related to this plan's model in the template."
+        ancestors = ancestors + (self,)
+        related = set()
+
+        for field in self.fields:
+            if field.relation is not None:
+                plan = field.plan(field.relation.related_model)
+                related.add(plan.model)
+
+                if plan not in ancestors:
+                    related.update(plan._related_models(ancestors))
+
+        return related
+
+    def _related_queryset(self, ancestors, relation, requires=()):
+        """Returns the queryset used to prefetch the objects of a related
+        accessor or `None` if they must be fetched per object.
+        """
+        options = self.options
+        prehook = options['prehook']
+
+        # Callable prehooks may depend on the parent object's queryset
+        if not options['optimize'] or \
+                isinstance(prehook, collections.Callable):
+            return None
+
+        if options['values_list'] and self.values_attrs is None:
+            return None
+
+        queryset = self.model._default_manager.all()
+
+        if prehook:
+            queryset = queryset.filter(**prehook)
+
+        ranked = queryset
+
+        if 'select_related' in options:
+            queryset = queryset.select_related(*options['select_related'])
+
+        if not options['values_list']:
+            queryset = self._only(self._annotate(queryset), requires)
+            queryset = self.prepare(queryset, ancestors)
+
+        if options['ordering']:
+            queryset = queryset.order_by(*options['ordering'])
+
+        if options['limit'] is not None:
+            queryset = _limit_per_parent(queryset, ranked, relation,
+                                         options['ordering'],
+                                         options['limit'])
+
+        return queryset
+
+    def _only_fields(self, ancestors=()):
+        """Returns the names of the concrete fields (and fields of related
+        objects that are selected) needed by the template, or `None` if they
+        are not known, e.g. for methods or hooks without the `requires`
+        option.
+        """
+        if self._only_names is _unset:
+            self._only_names = self._get_only_fields(ancestors)
+
+        return self._only_names
+
+    def _get_only_fields(self, ancestors):
+        options = self.options
+        requires = options['requires']
+
+        if not isinstance(self.model, type) or \
+                not issubclass(self.model, models.Model):
+            return None
 
-            if isinstance(value, models.Model):
-                if len(_options['fields']) == 1 and _options['flat'] \
-                        and not _options['merge']:
-                    value = list(serialize(value, **_options).values())[0]
+        # Hooks may use any attribute of the instance
+        if requires is None and (
+                self.prehook or self.posthook or self.batch_prehook or
+                self.batch_posthook or 'select_related' in options):
+            return None
+
+        ancestors = ancestors + (self,)
+        opts = self.model._meta
+        names = list(requires or ())
+
+        for field in self.fields:
+            relation = field.relation
+
+            if field.accessor == 'pk':
+                continue
+
+            if relation is None:
+                try:
+                    model_field = opts.get_field(field.accessor)
+                except models.FieldDoesNotExist:
+                    model_field = None
+
+                # Methods and properties are only known by `requires`
+                if model_field is None or not model_field.concrete:
+                    if requires is None:
+                        return None
+                    continue
+
+                names.append(model_field.name)
+
+            elif relation.many_to_many or relation.one_to_many:
+                continue
+
+            elif relation.concrete:
+                names.append(relation.name)
+                plan = field.plan(relation.related_model)
+
+                # Selected related objects are loaded in full unless their
+                # fields are listed
+                if plan not in ancestors:
+                    related = plan._get_only_fields(ancestors)
+
+                    if related is not None:
+                        names.extend(relation.name + '__' + x
+                                     for x in related)
+
+            # Reverse one-to-one relations
+            else:
+                return None
+
+        return names
+
+    def _optimizes(self, queryset):
+        """Returns true if the queryset can be optimized for the template,
+        i.e. it yields model instances (not `values`) that have not been
+        fetched yet.
+        """
+        return self.options['optimize'] and \
+            queryset._result_cache is None and queryset._fields is None
+
+    def _only(self, queryset, requires=()):
+        """Defers the fields that are not needed by the template, unless
+        the queryset already defers fields.
+        """
+        if not self._optimizes(queryset) or \
+                queryset.query.deferred_loading != (set(), True):
+            return queryset
+
+        names = self._only_fields()
+
+        if names is None:
+            return queryset
+
+        names = names + list(requires)
+
+        # Templates of only related objects need just the primary key
+        if not names:
+            names = [self.model._meta.pk.name]
+
+        return queryset.only(*names)
+
+    def prepare(self, queryset, ancestors=()):
+        """Applies the `select_related` and `prefetch_related` lookups
+        derived from the template to `queryset`.
+        """
+        select, prefetch = self._lookups(ancestors=ancestors)
+
+        if select:
+            queryset = queryset.select_related(*select)
+
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+
+        return queryset
+
+    def to_dict(self, instance):
+        "Takes a model instance and converts it into a dict."
+        if self.prehook:
+            instance = self.prehook(instance)
+            if instance is None:
+                return {}
+
+        if self.batch_prehook:
+            instances = self._batch_prehook([instance])
+
+            if not instances:
+                return {}
+
+            instance = instances[0]
+
+        if self._caches([instance]):
+            return self.cache.to_list([instance], prefetch=False)[0]
+
+        return self._serialize([instance])[0]
+
+    def _to_dict(self, instance):
+        attrs = {}
+        allow_missing = self.allow_missing
+        identity = _identity_map()
+        normalize = identity is not None and identity.normalize
+
+        # The accessors are specific to the model, a prehook may have
+        # returned some other object
+        resolved = instance.__class__ is self.model
+
+        for field in self.fields:
+            # Use the related objects if they have been prefetched
+            if field.prefetch_attr and \
+                    field.prefetch_attr in instance.__dict__:
+                plan = field.plan(field.relation.related_model)
+                objects = instance.__dict__[field.prefetch_attr]
+
+                if field.limit is not None:
+                    objects = objects[:field.limit]
+
+                if normalize and plan._normalizes():
+                    attrs[field.key] = plan._references(identity, objects)
+                else:
+                    attrs[field.key] = plan._format(plan._to_list(objects))
+                continue
+
+            # Related objects that were already serialized in this call are
+            # looked up by their key rather than fetched
+            _attrs = None
+
+            if identity is not None and resolved and field.attname:
+                plan = field.plan(field.relation.related_model)
+                pk = instance.__dict__.get(field.attname)
+
+                if not plan.prehook and not plan.batch_prehook:
+                    _attrs = identity.objects.get((plan, plan.model, pk))
+
+            if _attrs is None:
+                # Get the field value. Use the mapped value to the actually
+                # property or method name. `value` may be a number of things,
+                # so the various types are checked below.
+                if resolved and field.get is not None:
+                    value = field.get(instance, allow_missing)
                 else:
+                    value = get_field_value(instance, field.accessor,
+                                            allow_missing=allow_missing)
+
+                if isinstance(value, models.Model):
+                    plan = field.plan(value.__class__)
+                    pk = value.pk
+
                     # Recurse, get the dict representation
-                    _attrs = serialize(value, **_options)
+                    _attrs = plan.to_dict(value)
+
+                elif isinstance(value, QuerySet):
+                    plan = field.plan(value.model)
+
+                    if normalize and plan._normalizes():
+                        value = plan._references(identity, plan._fetch(value))
+                    else:
+                        value = plan.to_list(value)
+
+            if _attrs is not None:
+                if field.flatten:
+                    value = list(_attrs.values())[0]
 
-                    # Check if this object should be merged into the parent,
-                    # otherwise nest it under the accessor name
-                    if _options['merge']:
-                        attrs.update(_attrs)
-                        continue
+                # Check if this object should be merged into the parent,
+                # otherwise nest it under the accessor name
+                elif field.merge:
+                    attrs.update(_attrs)
+                    continue
 
+                elif normalize:
+                    value = identity.include(plan.model, pk, _attrs)
+
+                else:
                     value = _attrs
+
+            attrs[field.key] = value
+
+        if self.aggregates:
+            self._aggregate(instance, attrs)
+
+        # Apply post-hook to serialized attributes
+        if self.posthook:
+            attrs = self.posthook(instance, attrs)
+
+        return attrs
+
+    def _filter(self, queryset):
+        """Applies the `prehook`, `select_related`, `ordering` and `limit`
+        options to the queryset. Returns `None` if the prehook returns
+        `None`.
+        """
+        options = self.options
+        prehook = options['prehook']
+
+        if prehook:
+            if isinstance(prehook, collections.Callable):
+                queryset = prehook(queryset)
+                if queryset is None:
+                    return None
             else:
-                value = serialize(value, **_options)
+                queryset = queryset.filter(**prehook)
 
-        attrs[key] = value
+        # If the `select_related` option is defined, update the `QuerySet`
+        if 'select_related' in options:
+            queryset = queryset.select_related(*options['select_related'])
 
-    # Apply post-hook to serialized attributes
-    if options['posthook']:
-        attrs = options['posthook'](instance, attrs)
+        if not options['values_list']:
+            queryset = self._annotate(queryset)
 
-    return attrs
+        if options['ordering']:
+            queryset = queryset.order_by(*options['ordering'])
 
+        if options['limit'] is not None:
+            queryset = queryset[:options['limit']]
 
-def queryset_to_list(queryset, **options):
-    options = _defaults(options)
+        return queryset
+
+    def _annotate(self, queryset):
+        "Annotates the queryset with the aggregates."
+        # Objects that were already fetched are not fetched again
+        if self.aggregates and queryset._result_cache is None:
+            queryset = queryset.annotate(**dict(
+                (name, expression) for _, name, expression in
+                self.aggregates))
+
+        return queryset
+
+    def _aggregate(self, instance, attrs):
+        """Sets the aggregates of the instance. Instances that were not
+        fetched by an annotated queryset are queried.
+        """
+        # Rows of annotated `values` querysets
+        if isinstance(instance, dict):
+            values = instance
+
+            if any(name not in values for _, name, _ in self.aggregates):
+                return
+
+        elif not isinstance(instance, models.Model):
+            return
 
-    if options['prehook']:
-        if isinstance(options['prehook'], collections.Callable):
-            queryset = options['prehook'](queryset)
-            if queryset is None:
-                return []
         else:
-            queryset = queryset.filter(**options['prehook'])
-        options['prehook'] = False
+            values = instance.__dict__
+
+        if any(name not in values for _, name, _ in self.aggregates):
+            queryset = self._annotate(
+                self.model._default_manager.filter(pk=instance.pk))
+            values = queryset.values(*[x[1] for x in self.aggregates])[0]
 
-    # If the `select_related` option is defined, update the `QuerySet`
-    if 'select_related' in options:
-        queryset = queryset.select_related(*options['select_related'])
+        for key, name, _ in self.aggregates:
+            attrs[key] = values[name]
 
-    if options['values_list']:
-        fields = options['fields']
+    def _values_list(self, queryset):
+        fields = self.options['fields']
 
         # Flatten if only one field is being selected
         if len(fields) == 1:
-            queryset = queryset.values_list(fields[0], flat=options['flat'])
-        else:
-            queryset = queryset.values_list(*fields)
+            return queryset.values_list(fields[0], flat=self.options['flat'])
+
+        return queryset.values_list(*fields)
+
+    def to_list(self, queryset):
+        """Takes a queryset and converts it into a list of dicts, or the
+        output of the `format` option.
+        """
+        options = self.options
+        queryset = self._filter(queryset)
+
+        if queryset is None:
+            return self._format([])
+
+        if options['values_list']:
+            return list(self._values_list(queryset))
+
+        if self._optimizes(queryset):
+            # Templates of only concrete fields are selected as values
+            # rather than as model instances
+            columns = self._values_columns()
+
+            if columns is not None:
+                lookups, columns = columns
+                rows = queryset.values_list(*lookups)
+
+                if self.format != 'dicts':
+                    # Selectors may produce the same key more than once
+                    columns = [x for i, x in enumerate(columns)
+                               if x[0] not in [y[0] for y in columns[:i]]]
+                    return self._format_rows(
+                        [self._values_tuple(x, columns) for x in rows])
+
+                return [self._values_row(x, columns) for x in rows]
+
+            # Only the objects that are not cached are prefetched
+            if self._caches():
+                return self._format(
+                    self._chunk_to_list(list(self._select(queryset))))
+
+            # Otherwise the related objects are joined or prefetched
+            # rather than fetched per object
+            queryset = self.prepare(self._only(queryset))
+
+        return self._format(self._to_list(queryset))
+
+    def _format(self, objects):
+        "Converts a list of serialized objects to the `format`."
+        if self.format == 'dicts' or self.options['values_list']:
+            return objects
+
+        keys = self.keys
+
+        # Keys in the order they first appear
+        if keys is None:
+            keys = []
+            seen = set()
+
+            for attrs in objects:
+                for key in attrs:
+                    if key not in seen:
+                        seen.add(key)
+                        keys.append(key)
+
+        rows = [tuple([x.get(k) for k in keys]) for x in objects]
+        return self._format_rows(rows, keys)
+
+    def _format_rows(self, rows, keys=None):
+        keys = list(self.keys if keys is None else keys)
+
+        if self.format == 'tuples':
+            return {'keys': keys, 'rows': rows}
+
+        if not rows:
+            return dict((key, []) for key in keys)
+
+        return dict(zip(keys, [list(x) for x in zip(*rows)]))
+
+    def iterate(self, queryset, chunk_size=CHUNK_SIZE):
+        """Takes a queryset and returns an iterator of the serialized
+        objects, which are yielded one at a time.
+
+        Rows are read from the database in chunks of `chunk_size` and the
+        related objects are prefetched per chunk, so only one chunk of
+        instances is held in memory at a time. Raises `ValueError` if the
+        `format` is not `'dicts'`, since the tabular formats need all of
+        the objects.
+        """
+        if self.format != 'dicts' and not self.options['values_list']:
+            raise ValueError('Querysets cannot be streamed in the "{0}" '
+                             'format'.format(self.format))
+
+        return self._iterate(queryset, chunk_size)
+
+    def _iterate(self, queryset, chunk_size):
+        options = self.options
+        queryset = self._filter(queryset)
+
+        if queryset is None:
+            return
+
+        if queryset._result_cache is not None:
+            for attrs in self._to_list(queryset):
+                yield attrs
+            return
+
+        if options['values_list']:
+            for row in _iterator(self._values_list(queryset), chunk_size):
+                yield row
+            return
+
+        if self._optimizes(queryset):
+            columns = self._values_columns()
+
+            if columns is not None:
+                lookups, columns = columns
+                rows = _iterator(queryset.values_list(*lookups), chunk_size)
+
+                for row in rows:
+                    yield self._values_row(row, columns)
+                return
+
+            queryset = self._select(queryset)
+
+        chunk = []
+
+        for instance in _iterator(queryset, chunk_size):
+            chunk.append(instance)
+
+            if len(chunk) == chunk_size:
+                for attrs in self._chunk_to_list(chunk):
+                    yield attrs
+                chunk = []
+
+        for attrs in self._chunk_to_list(chunk):
+            yield attrs
+
+    def _select(self, queryset):
+        queryset = self._only(queryset)
+        select = self._lookups()[0]
+
+        if select:
+            queryset = queryset.select_related(*select)
+
+        return queryset
+
+    def _prefetch(self, instances):
+        # Rows of `values` querysets are not model instances
+        if instances and self.options['optimize'] and \
+                isinstance(instances[0], models.Model):
+            prefetch = self._lookups()[1]
+
+            if prefetch:
+                models.prefetch_related_objects(instances, *prefetch)
+
+    def _batch_prehook(self, instances):
+        result = self.batch_prehook(instances)
+
+        # The hook may change the list in place
+        if result is None:
+            return instances
+
+        return list(result)
+
+    def _serialize(self, instances):
+        "Serializes a list of instances and applies the batch posthook."
+        identity = _identity_map()
+
+        if identity is not None:
+            return self._serialize_once(identity, instances)
+
+        return self._serialize_all(instances)
+
+    def _serialize_all(self, instances):
+        to_dict = self._to_dict
+
+        # Generated functions do not use the identity map
+        if self.options['codegen'] and _identity_map() is None:
+            from .codegen import function
+            to_dict = function(self)
+
+        objects = [to_dict(x) for x in instances]
+
+        if self.batch_posthook:
+            if not isinstance(instances, list):
+                instances = list(instances)
+
+            result = self.batch_posthook(instances, objects)
+
+            if result is not None:
+                objects = list(result)
+
+        return objects
+
+    def _serialize_once(self, identity, instances):
+        """Serializes the instances that are not in the identity map and
+        returns the dicts of all of them.
+        """
+        objects = identity.objects
+        entries = []
+        missing = []
+        pending = set()
+
+        for instance in instances:
+            key = None
+
+            if isinstance(instance, models.Model) and instance.pk is not None:
+                key = (self, instance.__class__, instance.pk)
+
+            if key is not None and (key in objects or key in pending):
+                entries.append((key, None))
+                continue
+
+            if key is not None:
+                pending.add(key)
+
+            entries.append((key, len(missing)))
+            missing.append(instance)
+
+        serialized = self._serialize_all(missing)
+
+        for key, index in entries:
+            if key is not None and index is not None:
+                objects.setdefault(key, serialized[index])
+
+        return [objects[key] if index is None else serialized[index]
+                for key, index in entries]
+
+    def _caches(self, instances=()):
+        """Returns true if the serialized `instances` are cached. Only
+        model instances are cached, not the rows of `values` querysets.
+        Normalized objects reference related objects that are only included
+        in the output of the current call, so they are not cached either.
+        """
+        if self.cache is None:
+            return False
+
+        if any(not isinstance(x, models.Model) for x in instances):
+            return False
+
+        identity = _identity_map()
+
+        return identity is None or not identity.normalize
+
+    def _normalizes(self):
+        "Returns true if related objects of this plan are referenced."
+        return not self.options['values_list'] and not self.batch_prehook
+
+    def _fetch(self, queryset):
+        "Returns the instances of a related queryset that is not prefetched."
+        queryset = self._filter(queryset)
+
+        if queryset is None:
+            return []
+
+        if self._optimizes(queryset):
+            queryset = self.prepare(self._only(queryset))
+
         return list(queryset)
 
-    return [model_to_dict(x, **options) for x in queryset]
+    def _references(self, identity, objects):
+        """Serializes the objects into the identity map and returns their
+        primary keys.
+        """
+        objects = list(objects)
+
+        return [identity.include(x.__class__, x.pk, attrs)
+                for x, attrs in zip(objects, self._to_list(objects))]
+
+    def _chunk_to_list(self, instances):
+        if self._caches(instances):
+            if self.batch_prehook:
+                instances = self._batch_prehook(instances)
+
+            return self.cache.to_list(instances)
+
+        self._prefetch(instances)
+
+        if self.batch_prehook:
+            instances = self._batch_prehook(instances)
+
+        return self._serialize(instances)
+
+    def _values_tuple(self, row, columns):
+        return tuple([row[index] if prep is None else prep(row[index])
+                      for _, index, prep in columns])
+
+    def _values_row(self, row, columns):
+        attrs = {}
+
+        for key, index, prep in columns:
+            value = row[index]
+
+            if prep is not None:
+                value = prep(value)
+
+            attrs[key] = value
+
+        return attrs
+
+    def _to_list(self, objects):
+        "Converts already filtered objects into a list."
+        if self.options['values_list']:
+            attrs = self.values_attrs
+
+            if len(attrs) == 1 and self.options['flat']:
+                return [getattr(x, attrs[0]) for x in objects]
+
+            return [tuple([getattr(x, a) for a in attrs]) for x in objects]
+
+        if self.batch_prehook:
+            objects = self._batch_prehook(list(objects))
+
+        objects = list(objects)
+
+        if self._caches(objects):
+            return self.cache.to_list(objects, prefetch=False)
+
+        # The prehook has been applied to the queryset as a whole
+        return self._serialize(objects)
+
+
+# Functions of the `aggregates` option
+AGGREGATES = {
+    'count': models.Count,
+    'min': models.Min,
+    'max': models.Max,
+    'sum': models.Sum,
+    'avg': models.Avg,
+}
+
+
+def _aggregate_expression(model, spec):
+    """Returns the expression for an aggregate such as `'count:hackers'`.
+    Each aggregate is a correlated subquery, so aggregates over different
+    relations do not multiply each other's rows.
+    """
+    function, _, path = spec.partition(':')
+
+    if not path or (function != 'exists' and function not in AGGREGATES):
+        raise ValueError('Invalid aggregate "{0}"'.format(spec))
+
+    queryset = model._default_manager.filter(pk=models.OuterRef('pk'))
+
+    if function == 'exists':
+        return models.Exists(queryset.filter(**{path + '__isnull': False}))
+
+    if function == 'count':
+        aggregate = models.Count(path, distinct=True)
+    else:
+        aggregate = AGGREGATES[function](path)
+
+    queryset = queryset.order_by().values('pk') \
+        .annotate(_value=aggregate).values('_value')
+    output_field = queryset.query.annotations['_value'].output_field
+
+    return models.Subquery(queryset, output_field=output_field)
+
+
+# Output formats of querysets: a list of dicts, a dict of `keys` and `rows`
+# (tuples of the values in the order of the keys) or a dict of keys to
+# lists of values
+FORMATS = ('dicts', 'tuples', 'columnar')
+
+
+def _value_lookup(model, accessor):
+    """Returns the `values_list` lookup and the prep function applied by
+    `get_field_value` for a concrete non-relational field (or a foreign key
+    attribute name). Returns `(None, None)` for any other accessor.
+    """
+    if accessor == 'pk':
+        return accessor, None
+
+    try:
+        field = model._meta.get_field(accessor)
+    except models.FieldDoesNotExist:
+        return None, None
+
+    if not field.concrete or field.many_to_many:
+        return None, None
+
+    # The related object itself, not the key
+    if field.is_relation and accessor != field.attname:
+        return None, None
+
+    if field.__class__.__name__ in ('JSONField',):
+        return accessor, None
+
+    return accessor, field.get_prep_value
+
+
+def _values_attrs(model, names):
+    """Returns the instance attribute names for the `values_list` field
+    names or `None` if one of them is not a concrete field on `model`.
+    """
+    attrs = []
+
+    for name in names:
+        if name == 'pk':
+            name = model._meta.pk.name
+
+        try:
+            field = model._meta.get_field(name)
+        except models.FieldDoesNotExist:
+            return None
+
+        if not field.concrete or field.many_to_many:
+            return None
+
+        attrs.append(field.attname)
+
+    return attrs
+
+
+def _supports_window(connection):
+    "Returns true if the database supports window functions."
+    if connection.vendor == 'sqlite':
+        return connection.Database.sqlite_version_info >= (3, 25)
+
+    # MariaDB versions start at 10
+    if connection.vendor == 'mysql':
+        version = connection.mysql_version
+        return version >= (10, 2) or (8, 0, 2) <= version < (10,)
+
+    return connection.vendor in ('postgresql', 'oracle')
+
+
+def _parent_lookup(relation):
+    """Returns the lookup of the parent's key on the related model of a
+    reverse foreign key or many-to-many relation, or `None` for other
+    relations such as generic relations.
+    """
+    if isinstance(relation, models.ManyToOneRel):
+        return relation.field.attname
+
+    if isinstance(relation, models.ManyToManyRel):
+        return relation.field.name + '__pk'
+
+    if isinstance(relation, models.ManyToManyField) and \
+            not relation.remote_field.is_hidden():
+        return relation.related_query_name() + '__pk'
+
+    return None
+
+
+def _limit_per_parent(queryset, ranked, relation, ordering, limit):
+    """Filters the prefetch `queryset` to the first `limit` objects of each
+    parent, numbered by a `ROW_NUMBER()` window over the `ranked` queryset
+    partitioned by the parent's key. Objects related to more than one
+    parent are kept if they are among the first of any of them, so the
+    prefetched lists are still limited when they are serialized.
+
+    The queryset is returned as is if the database does not support window
+    functions or the ordering is not by field names.
+    """
+    connection = connections[queryset.db]
+    partition = _parent_lookup(relation)
+    ordering = list(ordering or queryset.model._meta.ordering) + ['pk']
+
+    if partition is None or not _supports_window(connection) or \
+            not all(isinstance(x, str) and not x.startswith('?')
+                    for x in ordering):
+        return queryset
+
+    # The SQL of the partition and ordering expressions, with the joins
+    # they require, is compiled by the ORM
+    ranked = ranked.order_by(partition, *ordering)
+    compiler = ranked.query.clone().get_compiler(connection=connection)
+    compiler.setup_query()
+    order_by = compiler.get_order_by()
+
+    sql, params = compiler.compile(order_by[0][0].expression)
+    params = list(params)
+    columns = []
+
+    for _, (column, column_params, _) in order_by[1:]:
+        columns.append(column)
+        params.extend(column_params)
+
+    row = 'ROW_NUMBER() OVER (PARTITION BY {0} ORDER BY {1})'.format(
+        sql, ', '.join(columns))
+    ranked = ranked.extra(select={'_preserialize_row': row},
+                          select_params=params)
+    sql, params = ranked.values('pk', '_preserialize_row').query \
+        .sql_with_params()
+
+    qn = connection.ops.quote_name
+    opts = queryset.model._meta
+    where = '{0}.{1} IN (SELECT _ranked.{1} FROM ({2}) _ranked WHERE ' \
+        '_ranked.{3} <= %s)'.format(qn(opts.db_table), qn(opts.pk.column),
+                                    sql, qn('_preserialize_row'))
+
+    return queryset.extra(where=[where], params=list(params) + [limit])
+
+
+def model_to_dict(instance, **options):
+    "Takes a model instance and converts it into a dict."
+    return _plan(instance.__class__, options).to_dict(instance)
+
+
+def queryset_to_list(queryset, stream=False, chunk_size=CHUNK_SIZE,
+                     workers=None, executor='thread', **options):
+    """Takes a queryset and converts it into a list of dicts. If `stream` is
+    true, a generator of dicts is returned instead (see `Plan.iterate`).
+
+    If `workers` is set, the queryset is serialized in a pool of that many
+    threads or processes, depending on `executor` (see `parallel`).
+    """
+    if workers:
+        if stream:
+            raise ValueError('Streamed querysets cannot be serialized '
+                             'by workers')
+
+        from .parallel import parallel_to_list
+        return parallel_to_list(queryset, workers, executor, **options)
+
+    plan = _plan(queryset.model, options)
+
+    if stream:
+        return plan.iterate(queryset, chunk_size)
+
+    return plan.to_list(queryset)
 
 
 class Serializer(object):
     def __init__(self, **options):
         self.options = options
 
-    def serialize(self, obj, fields=None, exclude=None, **options):
+    def plan(self, model, fields=None, exclude=None, **options):
+        """Returns the compiled `Plan` for serializing instances or
+        querysets of `model` with this serializer's options.
+        """
+        options = _merge({}, self.options, options)
+        return compile(model, fields, exclude, **options)
+
+    def serialize(self, obj, fields=None, exclude=None, tracer=None,
+                  identity=False, normalize=False, **options):
         """Recursively attempts to find ``Model`` and ``QuerySet`` instances
         to convert them into their representative datastructure per their
         ``Resource`` (if one exists).
+
+        If a `tracer` is given, the serialization of each model instance and
+        queryset is recorded by it (see `tracing.Tracer`).
+
+        If `identity` is true, each object is serialized once and its dict
+        is reused wherever the object occurs (see `IdentityMap`). If
+        `normalize` is true, related objects are output as their primary
+        keys and the output is a dict of the serialized `data` and the
+        `included` related objects.
         """
+        if (identity or normalize) and _identity_map() is None:
+            with identity_map(normalize) as objects:
+                data = self.serialize(obj, fields, exclude, tracer,
+                                      **options)
+
+            if normalize:
+                return {'data': data, 'included': objects.included}
+
+            return data
+
         options = _merge({}, self.options, options)
 
         # Handle model instances
         if isinstance(obj, models.Model):
-            fields = parse_selectors(obj.__class__, fields, exclude, **options)
-            return model_to_dict(obj, fields=fields, **options)
+            plan = compile(obj.__class__, fields, exclude, **options)
+
+            if tracer is not None:
+                with tracer.trace(plan) as plan:
+                    return plan.to_dict(obj)
+
+            return plan.to_dict(obj)
 
         # Handle querysets
         if isinstance(obj, QuerySet):
-            fields = parse_selectors(obj.model, fields, exclude, **options)
-            return queryset_to_list(obj, fields=fields, **options)
+            plan = compile(obj.model, fields, exclude, **options)
+
+            if tracer is not None:
+                with tracer.trace(plan) as plan:
+                    return plan.to_list(obj)
+
+            return plan.to_list(obj)
 
         # Handle dict instances
         if isinstance(obj, dict):
@@ -184,9 +1473,41 @@ class Serializer(object):
 
         # Handle other iterables
         if hasattr(obj, '__iter__'):
-            return [self.serialize(x, fields, exclude, **options) for x in obj]
+            return [self.serialize(x, fields, exclude, tracer, **options)
+                    for x in obj]
 
         return obj
 
+    def iter_serialize(self, obj, fields=None, exclude=None,
+                       chunk_size=CHUNK_SIZE, tracer=None, **options):
+        """Same as `serialize`, but yields the serialized items of a
+        ``QuerySet`` or other iterable one at a time. Querysets are read in
+        chunks of `chunk_size` rows. Any other object is yielded as the
+        single serialized item.
+        """
+        options = _merge({}, self.options, options)
+
+        if isinstance(obj, QuerySet):
+            plan = compile(obj.model, fields, exclude, **options)
+
+            if tracer is not None:
+                with tracer.trace(plan) as plan:
+                    for attrs in plan.iterate(obj, chunk_size):
+                        yield attrs
+                return
+
+            for attrs in plan.iterate(obj, chunk_size):
+                yield attrs
+
+        elif hasattr(obj, '__iter__') and not isinstance(obj, dict):
+            for x in obj:
+                yield self.serialize(x, fields, exclude, tracer, **options)
+
+        else:
+            yield self.serialize(obj, fields, exclude, tracer, **options)
+
+
+_serializer = Serializer()
 
-serialize = Serializer().serialize
+serialize = _serializer.serialize
+iter_serialize = _serializer.iter_serialize
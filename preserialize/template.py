@@ -0,0 +1,174 @@
+import threading
+import collections
+from django.db import models
+from django.db.models.query import QuerySet
+from .utils import fingerprint
+from .serialize import Serializer, _defaults, _cached_plan, compile
+
+
+class _FrozenDict(collections.Mapping):
+    "A read-only dict of template options, e.g. `aliases` or `prehook`."
+
+    def __init__(self, *args, **kwargs):
+        self._data = dict(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __hash__(self):
+        return hash(frozenset(self._data.items()))
+
+    def __repr__(self):
+        return repr(self._data)
+
+
+def _freeze(value, callables):
+    "Returns an immutable copy of a template value."
+    if isinstance(value, Template):
+        return value
+
+    if isinstance(value, dict):
+        return _FrozenDict((k, _freeze(v, callables))
+                           for k, v in value.items())
+
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x, callables) for x in value)
+
+    if isinstance(value, set):
+        return frozenset(_freeze(x, callables) for x in value)
+
+    return value
+
+
+class Template(collections.Mapping):
+    """A normalized, immutable template.
+
+    The options are defaulted once, nested `related` templates are converted
+    to `Template`s, dicts to read-only mappings and lists to tuples.
+    Templates are hashed and compared by their fingerprint (see
+    `utils.fingerprint`) which is computed up front according to the
+    `callables` policy, so plans compiled for a template are looked up by
+    the template itself.
+
+    Templates are mappings and can be passed anywhere a template dict is
+    accepted, e.g. `serialize(obj, **template)`.
+    """
+
+    def __init__(self, options=None, callables='path', **kwargs):
+        options = dict(options or {}, **kwargs)
+        options = _defaults(options)
+
+        related = options['related']
+        options['related'] = dict(
+            (k, v if isinstance(v, Template) else Template(v, callables))
+            for k, v in related.items())
+
+        self._options = dict((k, _freeze(v, callables))
+                             for k, v in options.items())
+        self.callables = callables
+        self.fingerprint = fingerprint(self._options, callables)
+        self._hash = hash(self.fingerprint)
+
+    def __getitem__(self, key):
+        return self._options[key]
+
+    def __iter__(self):
+        return iter(self._options)
+
+    def __len__(self):
+        return len(self._options)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, Template):
+            return self.fingerprint == other.fingerprint
+
+        return super(Template, self).__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '<Template: {0}>'.format(self.fingerprint[:12])
+
+    def copy(self, **options):
+        "Returns a new template with `options` replacing the current ones."
+        return Template(dict(self._options, **options), self.callables)
+
+    def plan(self, model):
+        "Returns the compiled plan of this template for `model`."
+        def factory():
+            options = dict(self._options)
+            fields = options.pop('fields', None)
+            exclude = options.pop('exclude', None)
+            return compile(model, fields, exclude, **options)
+
+        return _cached_plan(('template', model, self), factory)
+
+    def serialize(self, obj):
+        "Serializes `obj` with this template."
+        if isinstance(obj, models.Model):
+            return self.plan(obj.__class__).to_dict(obj)
+
+        if isinstance(obj, QuerySet):
+            return self.plan(obj.model).to_list(obj)
+
+        options = dict(self._options)
+        fields = options.pop('fields', None)
+        exclude = options.pop('exclude', None)
+        return Serializer(**options).serialize(obj, fields, exclude)
+
+
+class TemplateRegistry(object):
+    "A thread-safe registry of named templates."
+
+    def __init__(self):
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, template=None, **options):
+        """Registers a template under `name` and returns it. `template` may
+        be a `Template` or dict of options; keyword arguments are used as
+        the options if it is not given.
+        """
+        if template is None:
+            template = Template(options)
+        elif not isinstance(template, Template):
+            template = Template(template)
+
+        with self._lock:
+            self._templates[name] = template
+
+        return template
+
+    def unregister(self, name):
+        with self._lock:
+            self._templates.pop(name, None)
+
+    def get(self, name):
+        "Returns the template registered under `name`."
+        try:
+            return self._templates[name]
+        except KeyError:
+            raise LookupError('No template registered as "{0}"'.format(name))
+
+    def __contains__(self, name):
+        return name in self._templates
+
+    def __iter__(self):
+        return iter(list(self._templates))
+
+
+registry = TemplateRegistry()
+
+register = registry.register
+unregister = registry.unregister
+get_template = registry.get
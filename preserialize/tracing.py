@@ -0,0 +1,376 @@
+"""Instrumentation of the serialization of a template.
+
+A `Tracer` passed as the `tracer` option to `serialize` or `iter_serialize`
+receives a `Node` for each path of the template that was serialized, e.g.
+`''` for the top-level objects, `'libraries'` and `'libraries.tags'`. Each
+node records the number of rows serialized, the queries executed and the
+time spent, including reading the value of the accessor (e.g. a lazy
+foreign key or a method) and serializing the related objects. Posthooks are
+recorded as a separate node, e.g. `'libraries:posthook'`.
+
+Tracing is done on copies of the compiled plans, so serialization without
+a tracer is not affected.
+"""
+import time
+import logging
+import warnings
+import contextlib
+import collections
+from django.db import connections
+from .cache import ResultCache
+from .serialize import Plan, FieldPlan, CHUNK_SIZE, _value_lookup
+
+try:
+    from opentelemetry import trace as otel
+except ImportError:
+    otel = None
+
+
+class NPlusOneWarning(UserWarning):
+    "A related accessor executed queries for each object."
+
+
+class Node(object):
+    "The totals of a path of the template."
+
+    __slots__ = ('path', 'model', 'calls', 'rows', 'queries', 'query_calls',
+                 'seconds', 'own_seconds', 'start')
+
+    def __init__(self, path, model, start):
+        self.path = path
+        self.model = model
+        self.start = start
+        self.calls = 0
+        self.rows = 0
+        self.queries = 0
+
+        # The number of calls that executed at least one query
+        self.query_calls = 0
+
+        # Including and excluding the time of nested nodes
+        self.seconds = 0.0
+        self.own_seconds = 0.0
+
+    @property
+    def name(self):
+        if self.path:
+            return self.path
+
+        if self.model is None:
+            return '<root>'
+
+        return self.model._meta.label
+
+    def __repr__(self):
+        return '<Node {0}: {1} rows, {2} queries, {3:.6f}s>'.format(
+            self.name, self.rows, self.queries, self.seconds)
+
+
+class _Frame(object):
+    __slots__ = ('node', 'rows', 'start', 'queries', 'children')
+
+    def __init__(self, node=None):
+        self.node = node
+        self.rows = 0
+        self.children = 0.0
+
+
+class _QueryCounter(object):
+    """Counts the queries executed on the current thread's connections.
+
+    Uses `execute_wrapper` if available (Django 2.0+), otherwise the size
+    of the connections' query logs, which keep at most 9000 queries.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._wrappers = []
+        self._debug = []
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def start(self):
+        for connection in connections.all():
+            if hasattr(connection, 'execute_wrapper'):
+                wrapper = connection.execute_wrapper(self)
+                wrapper.__enter__()
+                self._wrappers.append(wrapper)
+            else:
+                self._debug.append((connection,
+                                    connection.force_debug_cursor,
+                                    len(connection.queries_log)))
+                connection.force_debug_cursor = True
+
+    def value(self):
+        return self.count + sum(len(c.queries_log) - n
+                                for c, _, n in self._debug)
+
+    def stop(self):
+        for wrapper in reversed(self._wrappers):
+            wrapper.__exit__(None, None, None)
+
+        for connection, debug, _ in self._debug:
+            connection.force_debug_cursor = debug
+
+        self._wrappers = []
+        self._debug = []
+
+
+class Tracer(object):
+    """Collects the nodes of a serialization and calls `record` with each
+    node when it is done.
+
+    If `n_plus_one` is true, a `NPlusOneWarning` is issued for each nested
+    node that executed queries in more than one call, i.e. once per parent
+    object rather than once for all of them.
+    """
+
+    timer = time.time
+
+    def __init__(self, n_plus_one=True):
+        self.n_plus_one = n_plus_one
+        self.nodes = collections.OrderedDict()
+        self._stack = []
+        self._counter = None
+        self._depth = 0
+
+    @contextlib.contextmanager
+    def trace(self, plan):
+        "Returns a traced copy of `plan` and records it until exited."
+        if self._depth == 0:
+            self.nodes = collections.OrderedDict()
+            self._counter = _QueryCounter()
+            self._counter.start()
+
+        self._depth += 1
+
+        try:
+            yield TracedPlan(plan, self, '')
+        finally:
+            self._depth -= 1
+
+            if self._depth == 0:
+                self._counter.stop()
+                self.finish()
+
+    @contextlib.contextmanager
+    def measure(self, path, model=None):
+        """Measures the time and queries of the block for the node at
+        `path`. Set `rows` on the returned frame to the number of objects
+        serialized by the block.
+        """
+        stack = self._stack
+
+        # Calls within the same node are measured by the outermost call
+        if stack and stack[-1].node.path == path:
+            yield _Frame()
+            return
+
+        start = self.timer()
+        node = self.nodes.get(path)
+
+        if node is None:
+            node = self.nodes[path] = Node(path, model, start)
+
+        frame = _Frame(node)
+        frame.start = start
+        frame.queries = self._counter.value()
+        stack.append(frame)
+
+        try:
+            yield frame
+        finally:
+            stack.pop()
+            seconds = self.timer() - frame.start
+            queries = self._counter.value() - frame.queries
+
+            node.calls += 1
+            node.rows += frame.rows
+            node.queries += queries
+            node.seconds += seconds
+            node.own_seconds += seconds - frame.children
+
+            if queries:
+                node.query_calls += 1
+
+            if stack:
+                stack[-1].children += seconds
+
+    def finish(self):
+        for node in self.nodes.values():
+            self.record(node)
+
+            if self.n_plus_one and node.path and node.query_calls > 1:
+                warnings.warn('"{0}" executed {1} queries in {2} calls'
+                              .format(node.name, node.queries,
+                                      node.query_calls), NPlusOneWarning)
+
+    def record(self, node):
+        "Called with each node when the serialization is done."
+
+
+class LoggingTracer(Tracer):
+    "Logs each node to `logger` at `level`."
+
+    def __init__(self, logger=None, level=logging.DEBUG, **kwargs):
+        super(LoggingTracer, self).__init__(**kwargs)
+        self.logger = logger or logging.getLogger('preserialize')
+        self.level = level
+
+    def record(self, node):
+        self.logger.log(self.level, '%s: %d rows, %d queries, %.6fs '
+                        '(%.6fs own)', node.name, node.rows, node.queries,
+                        node.seconds, node.own_seconds)
+
+
+class OpenTelemetryTracer(Tracer):
+    """Creates an OpenTelemetry span for each node, starting when the node
+    was first entered and lasting its total time. Requires the
+    `opentelemetry-api` package.
+    """
+
+    def __init__(self, tracer=None, **kwargs):
+        if otel is None:
+            raise ImportError('OpenTelemetryTracer requires the '
+                              'opentelemetry-api package')
+
+        super(OpenTelemetryTracer, self).__init__(**kwargs)
+        self.tracer = tracer or otel.get_tracer('preserialize')
+
+    def record(self, node):
+        start = int(node.start * 1e9)
+        span = self.tracer.start_span('preserialize ' + node.name,
+                                      start_time=start)
+        span.set_attribute('preserialize.path', node.path)
+        span.set_attribute('preserialize.rows', node.rows)
+        span.set_attribute('preserialize.queries', node.queries)
+        span.set_attribute('preserialize.calls', node.calls)
+        span.end(end_time=start + int(node.seconds * 1e9))
+
+
+def _count(objects):
+    "Returns the number of objects in the output of `Plan.to_list`."
+    if not isinstance(objects, dict):
+        return len(objects)
+
+    if 'rows' in objects:
+        return len(objects['rows'])
+
+    return max([len(x) for x in objects.values()] or [0])
+
+
+def _timed_getter(get, tracer, path, model):
+    def getter(obj, allow_missing=False):
+        with tracer.measure(path, model):
+            return get(obj, allow_missing)
+    return getter
+
+
+def _timed_posthook(posthook, tracer, path, model):
+    def hook(instance, attrs):
+        with tracer.measure(path, model):
+            return posthook(instance, attrs)
+    return hook
+
+
+class TracedFieldPlan(FieldPlan):
+    "A copy of a `FieldPlan` whose accessor and related plans are traced."
+
+    __slots__ = ('tracer', 'path', '_traced')
+
+    def __init__(self, field, model, tracer, path):
+        for name in FieldPlan.__slots__:
+            setattr(self, name, getattr(field, name))
+
+        self.tracer = tracer
+        self.path = path
+        self._traced = {}
+
+        # Only accessors that may query or compute the value are timed
+        if self.get is not None and (
+                field.relation is not None or
+                _value_lookup(model, field.accessor)[0] is None):
+            related = field.relation.related_model \
+                if field.relation is not None else None
+            self.get = _timed_getter(self.get, tracer, path, related)
+
+    def plan(self, model):
+        plan = self._traced.get(model)
+
+        if plan is None:
+            plan = TracedPlan(FieldPlan.plan(self, model), self.tracer,
+                              self.path)
+            self._traced[model] = plan
+
+        return plan
+
+
+class TracedPlan(Plan):
+    """A copy of a `Plan` that measures the objects it serializes. Queries
+    are planned by the original plan.
+    """
+
+    __slots__ = ('original', 'tracer', 'path')
+
+    def __init__(self, plan, tracer, path):
+        for name in Plan.__slots__:
+            setattr(self, name, getattr(plan, name))
+
+        self.original = plan
+        self.tracer = tracer
+        self.path = path
+
+        prefix = path + '.' if path else ''
+        self.fields = tuple(
+            TracedFieldPlan(x, plan.model, tracer, prefix + x.key)
+            for x in plan.fields)
+
+        if self.posthook:
+            self.posthook = _timed_posthook(self.posthook, tracer,
+                                            path + ':posthook', plan.model)
+
+        if self.cache is not None:
+            self.cache = ResultCache(self)
+
+        # Generated functions would not use the traced accessors
+        self._function = self._to_dict
+
+    def _lookups(self, prefix='', ancestors=()):
+        return self.original._lookups(prefix, ancestors)
+
+    def _related_models(self, ancestors=()):
+        return self.original._related_models(ancestors)
+
+    def to_dict(self, instance):
+        with self.tracer.measure(self.path, self.model) as frame:
+            frame.rows = 1
+            return Plan.to_dict(self, instance)
+
+    def to_list(self, queryset):
+        with self.tracer.measure(self.path, self.model) as frame:
+            objects = Plan.to_list(self, queryset)
+            frame.rows = _count(objects)
+            return objects
+
+    def _to_list(self, objects):
+        with self.tracer.measure(self.path, self.model) as frame:
+            objects = Plan._to_list(self, objects)
+            frame.rows = len(objects)
+            return objects
+
+    def iterate(self, queryset, chunk_size=CHUNK_SIZE):
+        iterator = Plan.iterate(self, queryset, chunk_size)
+
+        while True:
+            # Only the time spent producing each object is measured
+            with self.tracer.measure(self.path, self.model) as frame:
+                try:
+                    attrs = next(iterator)
+                except StopIteration:
+                    return
+
+                frame.rows = 1
+
+            yield attrs
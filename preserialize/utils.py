@@ -1,12 +1,29 @@
+import json
+import uuid
+import types
+import base64
+import decimal
+import hashlib
+import inspect
+import datetime
+import functools
+import threading
 import collections
 from django.db import models
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models.fields import Field
 from django.db.models import FieldDoesNotExist
+from django.db.models.signals import class_prepared
 
 
 PSEUDO_SELECTORS = (':all', ':pk', ':local', ':related')
 DEFAULT_SELECTORS = (':pk', ':local')
 
+# Options that do not affect the serialized output
+FINGERPRINT_EXCLUDE = ('cache', 'cache_timeout')
+
 
 def convert_to_camel(s):
     if '_' not in s:
@@ -15,8 +32,112 @@ def convert_to_camel(s):
     return toks[0] + ''.join(x.title() for x in toks[1:] if x.upper() != x)
 
 
+def convert_to_pascal(s):
+    s = convert_to_camel(s)
+    return s[:1].upper() + s[1:]
+
+
+def convert_to_kebab(s):
+    return s.replace('_', '-')
+
+
+# Named transforms for the `key_transform` option
+KEY_TRANSFORMS = {
+    'camel': convert_to_camel,
+    'pascal': convert_to_pascal,
+    'kebab': convert_to_kebab,
+}
+
+# Output keys by prefix, alias and transform. Like the compiled plans, the
+# cache is reset once it reaches the limit.
+KEY_CACHE_SIZE = 4096
+
+_keys = {}
+
+
+def transform_key(prefix, alias, transform=None):
+    """Returns the output key for `alias` with the `prefix` and `transform`
+    (the name of a transform in `KEY_TRANSFORMS` or a function) applied.
+    """
+    cache_key = (prefix, alias, transform)
+
+    try:
+        return _keys[cache_key]
+    except KeyError:
+        pass
+    except TypeError:
+        # Unhashable transforms are not cached
+        cache_key = None
+
+    if isinstance(transform, str):
+        if transform not in KEY_TRANSFORMS:
+            raise ValueError('Unknown key transform "{0}"'.format(transform))
+        transform = KEY_TRANSFORMS[transform]
+
+    key = prefix + alias
+
+    if transform:
+        key = transform(key)
+
+    if cache_key is not None:
+        if len(_keys) >= KEY_CACHE_SIZE:
+            _keys.clear()
+
+        _keys[cache_key] = key
+
+    return key
+
+
 class ModelFieldResolver(object):
-    cache = {}
+    """Resolves and caches the fields and accessors of model classes.
+
+    Reads do not lock; the cache is only locked when a model is added or
+    removed. If `max_size` is set, the models that were cached first are
+    evicted once the limit is reached. Functions added to `listeners` are
+    called with the model when it is invalidated (or `None` when the whole
+    cache is cleared).
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.cache = collections.OrderedDict()
+        self.accessors = collections.OrderedDict()
+        self.listeners = []
+        self._lock = threading.Lock()
+
+    def _store(self, cache, model, value):
+        with self._lock:
+            if model not in cache:
+                if self.max_size is not None:
+                    while cache and len(cache) >= self.max_size:
+                        cache.popitem(last=False)
+
+                cache[model] = value
+
+            return cache[model]
+
+    def invalidate(self, model):
+        "Removes the cached fields and accessors of `model`."
+        with self._lock:
+            self.cache.pop(model, None)
+            self.accessors.pop(model, None)
+
+        for listener in self.listeners:
+            listener(model)
+
+    def clear(self):
+        "Removes all cached fields and accessors."
+        with self._lock:
+            self.cache.clear()
+            self.accessors.clear()
+
+        for listener in self.listeners:
+            listener(None)
+
+    def warm(self, models):
+        "Resolves the fields of `models` ahead of time."
+        for model in models:
+            self._get_fields(model)
 
     def _get_pk_field(self, model):
         fields = (model._meta.pk,)
@@ -63,7 +184,9 @@ class ModelFieldResolver(object):
         }
 
     def _get_fields(self, model):
-        if model not in self.cache:
+        fields = self.cache.get(model)
+
+        if fields is None:
             fields = {}
             fields.update(self._get_pk_field(model))
             fields.update(self._get_local_fields(model))
@@ -75,9 +198,9 @@ class ModelFieldResolver(object):
 
             fields[':all'] = all_
 
-            self.cache[model] = fields
+            fields = self._store(self.cache, model, fields)
 
-        return self.cache[model]
+        return fields
 
     def get_field(self, model, attr):
         fields = self._get_fields(model)
@@ -89,8 +212,96 @@ class ModelFieldResolver(object):
         # Assume a field or property
         return attr
 
+    def get_relation(self, model, accessor):
+        """Returns the relational field (or reverse relation) for the
+        `accessor` on `model`, or `None` if it is not a relation.
+        """
+        field = self._get_fields(model)[':all'].get(accessor)
+
+        if field is not None and field.is_relation and field.related_model:
+            return field
 
-resolver = ModelFieldResolver()
+    def get_accessor(self, model, name):
+        """Returns a function that takes an instance of `model` and the
+        `allow_missing` flag and returns the value of `name` the same way
+        `get_field_value` does. The kind of attribute (field, relation,
+        method, etc.) is determined once per model and name.
+        """
+        accessors = self.accessors.get(model)
+
+        if accessors is None:
+            accessors = self._store(self.accessors, model, {})
+
+        getter = accessors.get(name)
+
+        if getter is None:
+            getter = accessors[name] = self._get_accessor(model, name)
+
+        return getter
+
+    def _get_accessor(self, model, name):
+        if not isinstance(model, type) or not issubclass(model, models.Model):
+            return _generic_getter(name)
+
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            field = None
+
+        if isinstance(field, Field):
+            # Local many-to-many and generic relations
+            if field.many_to_many or field.one_to_many:
+                return _manager_getter(name)
+
+            # Local foreign key or one-to-one, the related object itself
+            if field.is_relation and name != field.attname:
+                return _attr_getter(name)
+
+            if field.__class__.__name__ in ('JSONField',):
+                return _attr_getter(name)
+
+            return _prep_getter(name, field.get_prep_value)
+
+        relation = self._get_fields(model)[':related'].get(name)
+
+        if relation is not None:
+            if relation.one_to_one:
+                return _attr_getter(name)
+
+            return _manager_getter(name)
+
+        attr = getattr(model, name, None)
+
+        if isinstance(attr, property):
+            return _value_getter(name)
+
+        if inspect.isfunction(attr) or inspect.ismethod(attr):
+            return _method_getter(name)
+
+        return _generic_getter(name)
+
+
+resolver = ModelFieldResolver(
+    max_size=getattr(settings, 'PRESERIALIZE_RESOLVER_CACHE_SIZE', None))
+
+
+def _model_prepared(sender, **kwargs):
+    # A new model class changes the reverse relations of the models it
+    # relates to, in addition to replacing a model of the same name
+    resolver.invalidate(sender)
+
+    for field in sender._meta.local_fields + sender._meta.local_many_to_many:
+        if field.is_relation and isinstance(field.remote_field.model, type):
+            resolver.invalidate(field.remote_field.model)
+
+
+def _setting_changed(setting, **kwargs):
+    if setting == 'INSTALLED_APPS':
+        resolver.clear()
+
+
+class_prepared.connect(_model_prepared)
+setting_changed.connect(_setting_changed)
 
 
 def parse_selectors(model, fields=None, exclude=None, key_map=None, **options):
@@ -125,6 +336,66 @@ def parse_selectors(model, fields=None, exclude=None, key_map=None, **options):
     return tuple([x for x in validated if x not in exclude])
 
 
+def _generic_getter(name):
+    def getter(obj, allow_missing=False):
+        return get_field_value(obj, name, allow_missing)
+    return getter
+
+
+# The getters of attributes that may be missing (related objects and
+# properties) fall back to `get_field_value`, so they are handled the same
+# way. Fields, managers and methods are always present on the model.
+
+def _prep_getter(name, prep):
+    def getter(obj, allow_missing=False):
+        return prep(getattr(obj, name))
+    return getter
+
+
+def _attr_getter(name):
+    def getter(obj, allow_missing=False):
+        try:
+            return getattr(obj, name)
+        except AttributeError:
+            return get_field_value(obj, name, allow_missing)
+    return getter
+
+
+def _manager_getter(name):
+    def getter(obj, allow_missing=False):
+        return getattr(obj, name).all()
+    return getter
+
+
+def _value_getter(name):
+    def getter(obj, allow_missing=False):
+        try:
+            value = getattr(obj, name)
+        except AttributeError:
+            return get_field_value(obj, name, allow_missing)
+        return _resolve_value(value)
+    return getter
+
+
+def _method_getter(name):
+    def getter(obj, allow_missing=False):
+        return getattr(obj, name)()
+    return getter
+
+
+def _resolve_value(value):
+    # Handle a local many-to-many or a reverse foreign key
+    if value.__class__.__name__ in ('RelatedManager', 'ManyRelatedManager',
+                                    'GenericRelatedObjectManager'):
+        value = value.all()
+
+    # Check for callable
+    elif isinstance(value, collections.Callable):
+        value = value()
+
+    return value
+
+
 def get_field_value(obj, name, allow_missing=False):
     value = None
 
@@ -149,13 +420,125 @@ def get_field_value(obj, name, allow_missing=False):
     elif not allow_missing:
         raise ValueError('{} has no attribute {}'.format(obj, name))
 
-    # Handle a local many-to-many or a reverse foreign key
-    if value.__class__.__name__ in ('RelatedManager', 'ManyRelatedManager',
-                                    'GenericRelatedObjectManager'):
-        value = value.all()
+    return _resolve_value(value)
 
-    # Check for callable
-    elif isinstance(value, collections.Callable):
-        value = value()
 
-    return value
+class _Described(str):
+    "A description that is used as is."
+
+
+def _describe(value, callables='path'):
+    if isinstance(value, _Described):
+        return value
+
+    if isinstance(value, collections.Mapping):
+        return '{%s}' % ','.join(sorted('%r:%s' % (k, _describe(v, callables))
+                                        for k, v in value.items()))
+
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(_describe(x, callables) for x in value)
+
+    if isinstance(value, (set, frozenset)):
+        return '{%s}' % ','.join(sorted(_describe(x, callables)
+                                        for x in value))
+
+    if value is None or isinstance(value, (bool, int, float, str, bytes,
+                                           decimal.Decimal, uuid.UUID,
+                                           datetime.date, datetime.time,
+                                           datetime.timedelta)):
+        return repr(value)
+
+    if isinstance(value, models.Model):
+        opts = value._meta.concrete_model._meta
+        return '<%s.%s:%r>' % (opts.app_label, opts.model_name, value.pk)
+
+    if isinstance(value, functools.partial):
+        return 'partial(%s,%s,%s)' % (_describe(value.func, callables),
+                                      _describe(value.args, callables),
+                                      _describe(value.keywords or {},
+                                                callables))
+
+    # Bound methods depend on the object they are bound to, which must be
+    # described as well
+    owner = getattr(value, '__self__', None)
+
+    if owner is not None and not isinstance(owner, types.ModuleType):
+        return '%s.%s' % (_describe(owner, callables), value.__name__)
+
+    # Functions and classes are described by their import path. Lambdas
+    # and nested functions may depend on state that is not visible.
+    name = getattr(value, '__qualname__', getattr(value, '__name__', None))
+    module = getattr(value, '__module__', None)
+
+    if name and module and '<' not in name:
+        return '%s.%s' % (module, name)
+
+    # The identity is only unique while the object is alive, which is the
+    # case as long as the template referencing it is
+    if callables == 'identity':
+        return '<%s:%#x>' % (type(value).__name__, id(value))
+
+    raise ValueError('{0!r} cannot be described by its import path'
+                     .format(value))
+
+
+def _describe_template(options, callables):
+    options = dict((k, v) for k, v in options.items()
+                   if k not in FINGERPRINT_EXCLUDE)
+
+    if options.get('related'):
+        options['related'] = dict(
+            (k, _Described(_describe_template(v, callables)))
+            for k, v in options['related'].items())
+
+    return _describe(options, callables)
+
+
+def fingerprint(options, callables='path'):
+    """Returns a digest of the template options.
+
+    With the `'path'` policy, functions and classes are described by their
+    import path so the digest is the same across processes, and `ValueError`
+    is raised for values, such as lambdas, that cannot be described. The
+    `'identity'` policy describes those values by their identity instead,
+    so the digest is only valid within the process.
+    """
+    if callables not in ('path', 'identity'):
+        raise ValueError('Unknown callables policy "{0}"'.format(callables))
+
+    description = _describe_template(options, callables)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+def encode_token(data):
+    """Returns an opaque, URL-safe token of JSON serializable `data`, such
+    as a pagination cursor.
+    """
+    value = json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':'))
+    token = base64.urlsafe_b64encode(value.encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+
+def decode_token(token):
+    "Returns the data of a token. Raises `ValueError` if it is invalid."
+    try:
+        token = str(token)
+        value = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        return json.loads(value.decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('Invalid token "{0}"'.format(token))
+
+
+def get_model_field(model, path):
+    """Returns the model field of a lookup path such as `'user__username'`.
+    Raises `FieldDoesNotExist` if a part of the path does not exist.
+    """
+    names = path.split('__')
+
+    for name in names[:-1]:
+        model = model._meta.get_field(name).related_model
+
+    if names[-1] == 'pk':
+        return model._meta.pk
+
+    return model._meta.get_field(names[-1])
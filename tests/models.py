@@ -1,5 +1,9 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.fields import GenericForeignKey, \
+    GenericRelation
+from django.contrib.contenttypes.models import ContentType
+from preserialize.models import AbstractTombstone
 
 
 class Tag(models.Model):
@@ -21,3 +25,24 @@ class Hacker(models.Model):
     def signature(self):
         return '{0}  <{1}>  {2}'.format(self.user.get_full_name(),
                 self.user.email, self.website)
+
+
+class Category(models.Model):
+    name = models.CharField(max_length=50)
+    parent = models.ForeignKey('self', null=True, related_name='children')
+
+
+class Note(models.Model):
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    content_object = GenericForeignKey()
+    text = models.CharField(max_length=100)
+
+
+class Article(models.Model):
+    title = models.CharField(max_length=100)
+    notes = GenericRelation(Note)
+
+
+class Tombstone(AbstractTombstone):
+    pass
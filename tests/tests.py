@@ -1,10 +1,25 @@
+import io
+import sys
+import json
+import types
+import decimal
 import unittest
+import warnings
 import datetime
+from django.db import connection, transaction
+from django.apps import apps
+from django.db.models.signals import pre_init, class_prepared, post_delete
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.db.models.query import QuerySet
 from django.contrib.auth.models import User
-from preserialize import utils
-from preserialize.serialize import serialize
-from .models import Tag, Library, Hacker
+from preserialize import utils, encode, cache, template, parallel, codegen, \
+    tracing, pagination, fieldsets, conditional, changes
+from preserialize.serialize import serialize, iter_serialize, compile, \
+    queryset_to_list, Serializer, _supports_window
+from .models import Tag, Library, Hacker, Tombstone, Article, Note, \
+    Category
 
 
 class ModelSerializer(unittest.TestCase):
@@ -196,6 +211,38 @@ class ModelSerializer(unittest.TestCase):
             }]
         }])
 
+    def test_recursive_template(self):
+        root = Category.objects.create(name='Languages')
+        child = Category.objects.create(name='Python', parent=root)
+        Category.objects.create(name='Django', parent=child)
+
+        template = {'fields': ['name', 'parent']}
+        template['related'] = {'parent': template}
+        expected = {'name': 'Django', 'parent': {
+            'name': 'Python', 'parent': {'name': 'Languages',
+                                         'parent': None}}}
+
+        # The output ends where the data ends
+        self.assertEqual(serialize(Category.objects.get(name='Django'),
+                                   **template), expected)
+        self.assertEqual(serialize(Category.objects.order_by('pk'),
+                                   **template)[2], expected)
+
+        # The related objects use the plan of the template itself
+        plan = compile(Category, **template)
+        self.assertTrue(plan.fields[1].plan(Category) is plan)
+
+        template = {'fields': ['name', 'children']}
+        template['related'] = {'children': template}
+        self.assertEqual(serialize(Category.objects.filter(pk=root.pk),
+                                   **template), [
+            {'name': 'Languages', 'children': [
+                {'name': 'Python', 'children': [
+                    {'name': 'Django', 'children': []}]}]}])
+
+        Category.objects.update(parent=None)
+        Category.objects.all().delete()
+
     def test_fields(self):
         obj = serialize(self.hackers, fields=['website'], values_list=True)
         self.assertEqual(obj, [
@@ -363,3 +410,952 @@ class ModelSerializer(unittest.TestCase):
             'foo': 1,
             'user': 'John',
         })
+
+    def test_compile(self):
+        template = {
+            'fields': ['website', 'user'],
+            'camelcase': True,
+            'prefix': 'hacker_',
+            'related': {'user': {'fields': ['first_name']}},
+        }
+        plan = compile(Hacker, **template)
+
+        # Equal templates share the same plan
+        self.assertTrue(compile(Hacker, **template) is plan)
+        self.assertTrue(Serializer().plan(Hacker, **template) is plan)
+
+        self.assertEqual([x.key for x in plan.fields],
+                         ['hackerWebsite', 'hackerUser'])
+        self.assertEqual(plan.to_list(self.hackers),
+                         serialize(self.hackers, **template))
+        self.assertEqual(plan.to_dict(self.hackers[0]), {
+            'hackerWebsite': 'http://ejohn.org',
+            'hackerUser': 'John',
+        })
+
+    def test_prefetch(self):
+        # Hackers joined with their users, groups, permissions, libraries
+        # and the libraries' tags regardless of the number of rows
+        with CaptureQueriesContext(connection) as ctx:
+            serialize(self.hackers)
+        self.assertEqual(len(ctx), 5)
+
+        template = {
+            'fields': ['name', 'libraries'],
+            'related': {
+                'libraries': {
+                    'fields': ['name'],
+                    'values_list': True,
+                    'prehook': {'language': 'javascript'},
+                },
+            },
+        }
+        with CaptureQueriesContext(connection) as ctx:
+            obj = serialize(self.tags, **template)
+        self.assertEqual(len(ctx), 2)
+        self.assertEqual(obj, [
+            {'name': 'javascript', 'libraries': ['jQuery', 'Backbone']},
+            {'name': 'dom', 'libraries': ['jQuery']},
+            {'name': 'python', 'libraries': []},
+            {'name': 'django', 'libraries': []},
+        ])
+
+        # Disabling the optimization falls back to a query per tag
+        with CaptureQueriesContext(connection) as ctx:
+            serialize(self.tags, optimize=False, **template)
+        self.assertEqual(len(ctx), 5)
+
+    def test_values(self):
+        template = {
+            'fields': ['website', 'user', 'uid'],
+            'aliases': {'uid': 'user_id'},
+            'prefix': 'hacker_',
+            'camelcase': True,
+            'related': {'user': {'fields': ['first_name']}},
+        }
+
+        inits = []
+
+        def receiver(sender, **kwargs):
+            inits.append(sender)
+
+        pre_init.connect(receiver)
+        try:
+            obj = serialize(self.hackers, **template)
+        finally:
+            pre_init.disconnect(receiver)
+
+        self.assertEqual(inits, [])
+
+        # Many-to-many relations are not selected as values, which would
+        # repeat the object for each related object
+        libraries = serialize(Library.objects.filter(pk=4),
+                              fields=['name', 'tags'],
+                              related={'tags': {'fields': ['name']}})
+        self.assertEqual(libraries, [{'name': 'Django', 'tags': [
+            {'name': 'python'}, {'name': 'django'}]}])
+        self.assertEqual(obj, serialize(self.hackers, optimize=False,
+                                        **template))
+        self.assertEqual(obj[0], {
+            'hackerWebsite': 'http://ejohn.org',
+            'hackerUser': 'John',
+            'hackerUid': 1,
+        })
+
+    def test_iter_serialize(self):
+        objects = iter_serialize(self.hackers, chunk_size=2)
+        self.assertTrue(isinstance(objects, types.GeneratorType))
+
+        # One query for the hackers and related objects prefetched per chunk
+        with CaptureQueriesContext(connection) as ctx:
+            objects = list(objects)
+        self.assertEqual(len(ctx), 9)
+        self.assertEqual(objects, serialize(self.hackers))
+
+        objects = queryset_to_list(self.tags, stream=True, fields=['name'])
+        self.assertEqual(list(objects), [
+            {'name': 'javascript'},
+            {'name': 'dom'},
+            {'name': 'python'},
+            {'name': 'django'},
+        ])
+
+    def test_key_transform(self):
+        user = User.objects.get(pk=1)
+        template = {'fields': ['first_name', 'last_login'], 'prefix': 'user_'}
+
+        self.assertEqual(sorted(serialize(user, key_transform='pascal',
+                                          **template)),
+                         ['UserFirstName', 'UserLastLogin'])
+        self.assertEqual(sorted(serialize(user, key_transform='kebab',
+                                          **template)),
+                         ['user-first-name', 'user-last-login'])
+        self.assertEqual(sorted(serialize(user, key_transform=str.upper,
+                                          **template)),
+                         ['USER_FIRST_NAME', 'USER_LAST_LOGIN'])
+        self.assertEqual(serialize(user, camelcase=True, **template),
+                         serialize(user, key_transform='camel', **template))
+
+        self.assertTrue(('user_', 'first_name', 'kebab') in utils._keys)
+        self.assertRaises(ValueError, serialize, user, key_transform='x',
+                          **template)
+
+    def test_batch_hooks(self):
+        calls = []
+
+        def batch_prehook(instances):
+            calls.append(len(instances))
+            return [x for x in instances if x.pk != 2]
+
+        def batch_posthook(instances, objects):
+            names = dict(Tag.objects.filter(pk__in=[x.pk for x in instances])
+                         .values_list('pk', 'name'))
+
+            for instance, attrs in zip(instances, objects):
+                attrs['upper'] = names[instance.pk].upper()
+
+        template = {'fields': ['id'], 'batch_prehook': batch_prehook,
+                    'batch_posthook': batch_posthook}
+
+        # One call per chunk
+        objects = list(iter_serialize(Tag.objects.all(), chunk_size=3,
+                                      **template))
+        self.assertEqual(calls, [3, 1])
+        self.assertEqual(objects, [
+            {'id': 1, 'upper': 'JAVASCRIPT'},
+            {'id': 3, 'upper': 'PYTHON'},
+            {'id': 4, 'upper': 'DJANGO'},
+        ])
+        self.assertEqual(serialize(Tag.objects.all(), **template), objects)
+        self.assertEqual(serialize(Tag.objects.get(pk=2), **template), {})
+
+        # Applied to prefetched related objects
+        obj = serialize(Library.objects.get(pk=1), fields=['tags'], related={
+            'tags': template,
+        })
+        self.assertEqual(obj, {'tags': [{'id': 1, 'upper': 'JAVASCRIPT'}]})
+
+    def test_aggregates(self):
+        template = {'fields': ['name'], 'aggregates': {
+            'hacker_count': 'count:hackers',
+            'has_tags': 'exists:tags',
+            'last_tag': 'max:tags__name',
+        }}
+
+        # Selected with the libraries
+        with CaptureQueriesContext(connection) as ctx:
+            obj = serialize(Library.objects.order_by('pk'), **template)
+        self.assertEqual(len(ctx), 1)
+        self.assertEqual(obj[0], {'name': 'jQuery', 'hacker_count': 1,
+                                  'has_tags': True, 'last_tag': 'javascript'})
+        self.assertEqual(obj[3]['hacker_count'], 1)
+
+        self.assertEqual(serialize(Library.objects.get(pk=1), **template),
+                         obj[0])
+
+        # And with prefetched related objects
+        template['aggregates'] = {'tag_count': 'count:tags'}
+
+        with CaptureQueriesContext(connection) as ctx:
+            obj = serialize(Tag.objects.filter(pk=1), fields=['libraries'],
+                            related={'libraries': template})
+        self.assertEqual(len(ctx), 2)
+        self.assertEqual([x['tag_count'] for x in obj[0]['libraries']],
+                         [2, 1, 1])
+
+        self.assertRaises(ValueError, serialize, Library.objects.all(),
+                          aggregates={'x': 'median:tags'})
+
+    def test_only(self):
+        def sql(*args, **kwargs):
+            with CaptureQueriesContext(connection) as ctx:
+                serialize(*args, **kwargs)
+            return ctx.captured_queries[0]['sql']
+
+        # Only the selected columns of the hacker and user are loaded
+        query = sql(Hacker.objects.all(), fields=['user', 'libraries'],
+                    posthook=lambda instance, attrs: attrs,
+                    requires=['website'], related={
+                        'user': {'fields': ['username']},
+                        'libraries': {'fields': ['name']}})
+        self.assertTrue('"website"' in query)
+        self.assertTrue('"username"' in query)
+        self.assertFalse('"email"' in query)
+
+        # Methods need every column unless the required ones are listed
+        query = sql(User.objects.all(), fields=['username', 'get_full_name'])
+        self.assertTrue('"email"' in query)
+        query = sql(User.objects.all(), fields=['username', 'get_full_name'],
+                    requires=['first_name', 'last_name'])
+        self.assertTrue('"last_name"' in query)
+        self.assertFalse('"email"' in query)
+
+        self.assertEqual(serialize(Hacker.objects.all(), fields=['user'],
+                                   related={'user': {'fields': ['username']}},
+                                   posthook=lambda instance, attrs: dict(
+                                       attrs, url=instance.website),
+                                   requires=['website'])[0],
+                         {'user': 'ejohn', 'url': 'http://ejohn.org'})
+
+    def test_format(self):
+        template = {'fields': ['id', 'tag_name'], 'aliases': {
+            'tag_name': 'name'}, 'camelcase': True}
+        tags = Tag.objects.filter(pk__lte=2)
+
+        self.assertEqual(serialize(tags, format='tuples', **template), {
+            'keys': ['id', 'tagName'],
+            'rows': [(1, 'javascript'), (2, 'dom')],
+        })
+        self.assertEqual(serialize(tags, format='columnar', **template), {
+            'id': [1, 2],
+            'tagName': ['javascript', 'dom'],
+        })
+        self.assertEqual(queryset_to_list(tags.none(), format='columnar',
+                                          fields=['id']), {'id': []})
+
+        # Model instances, related objects and keys added by hooks
+        obj = serialize(Library.objects.filter(pk=1), fields=['name', 'tags'],
+                        format='tuples', related={
+                            'tags': {'fields': ['name'], 'format': 'columnar',
+                                     'posthook': lambda instance, attrs: dict(
+                                         attrs, upper=attrs['name'].upper())}})
+        self.assertEqual(obj, {'keys': ['name', 'tags'], 'rows': [
+            ('jQuery', {'name': ['javascript', 'dom'],
+                        'upper': ['JAVASCRIPT', 'DOM']}),
+        ]})
+
+        self.assertEqual(
+            queryset_to_list(Tag.objects.all(), workers=2, format='tuples',
+                             fields=['id'])['rows'], [(1,), (2,), (3,), (4,)])
+
+        # Streamed querysets are only output as dicts
+        for format in ['tuples', 'columnar']:
+            self.assertRaises(ValueError, queryset_to_list, tags,
+                              stream=True, format=format, **template)
+            self.assertRaises(ValueError, list, iter_serialize(
+                tags, format=format, **template))
+            self.assertRaises(ValueError, list, encode.iter_json(
+                tags, format=format, **template))
+
+    def test_paginate(self):
+        template = {'fields': ['name'], 'aggregates': {'tags': 'count:tags'}}
+
+        page = pagination.paginate_serialize(Library.objects.all(),
+                                             page_size=3, **template)
+        self.assertEqual([x['name'] for x in page['results']],
+                         ['jQuery', 'Backbone', 'CoffeeScript'])
+        self.assertEqual(page['results'][0]['tags'], 2)
+
+        # The next page is selected by the values of the last row
+        with CaptureQueriesContext(connection) as ctx:
+            page = pagination.paginate_serialize(
+                Library.objects.all(), cursor=page['next'], page_size=3,
+                **template)
+        self.assertEqual(len(ctx), 2)
+        self.assertTrue('OFFSET' not in ctx.captured_queries[0]['sql'])
+        self.assertEqual(page, {'results': [{'name': 'Django', 'tags': 2}],
+                                'next': None})
+
+        # Ordering by a non-unique field in descending order
+        names = []
+        cursor = None
+
+        while True:
+            page = pagination.paginate_serialize(
+                Library.objects.all(), cursor=cursor, page_size=1,
+                ordering=['-language'], fields=['name'])
+            names.extend(x['name'] for x in page['results'])
+            cursor = page['next']
+
+            if cursor is None:
+                break
+
+        self.assertEqual(names, ['Django', 'Backbone', 'jQuery',
+                                 'CoffeeScript'])
+
+        self.assertRaises(ValueError, pagination.paginate_serialize,
+                          Library.objects.all(), cursor=utils.encode_token(
+                              {'ordering': ['name'], 'values': ['x']}))
+        self.assertRaises(ValueError, pagination.paginate_serialize,
+                          Library.objects.all(), cursor='!')
+
+        # Times are compared with their microseconds
+        joined = datetime.datetime(2009, 5, 16, 15, 52, 40)
+
+        for pk, microsecond in ((1, 300), (2, 100), (3, 200)):
+            User.objects.filter(pk=pk).update(
+                date_joined=joined.replace(microsecond=microsecond))
+
+        for ordering, expected in ((['date_joined'], [2, 3, 1]),
+                                   (['-date_joined'], [1, 3, 2])):
+            pks = []
+            cursor = None
+
+            for i in range(len(expected)):
+                page = pagination.paginate_serialize(
+                    User.objects.filter(pk__in=expected), cursor=cursor,
+                    page_size=1, ordering=ordering, fields=['id'])
+                pks.extend(x['id'] for x in page['results'])
+                cursor = page['next']
+
+            self.assertEqual(pks, expected)
+            self.assertEqual(cursor, None)
+
+    def test_parallel(self):
+        template = {'fields': ['user', 'signature', 'libraries']}
+        self.assertEqual(
+            queryset_to_list(Hacker.objects.all(), workers=2, **template),
+            queryset_to_list(Hacker.objects.all(), **template))
+
+        # Partitions keep the ordering of the queryset
+        tags = Tag.objects.order_by('name')
+        self.assertEqual(len(parallel.partition(tags, 3)), 2)
+        self.assertEqual(queryset_to_list(tags, workers=3, fields=['name']),
+                         [{'name': 'django'}, {'name': 'dom'},
+                          {'name': 'javascript'}, {'name': 'python'}])
+        self.assertEqual(queryset_to_list(Tag.objects.order_by('-pk'),
+                                          workers=2, fields=['id']),
+                         [{'id': 4}, {'id': 3}, {'id': 2}, {'id': 1}])
+
+        # Uncommitted rows are serialized and the transaction continues
+        for executor in parallel.EXECUTORS:
+            with transaction.atomic():
+                Tag.objects.create(name='{0}s'.format(executor))
+                tags = queryset_to_list(Tag.objects.all(), workers=2,
+                                        executor=executor, fields=['name'])
+                self.assertEqual(len(tags), Tag.objects.count())
+                self.assertEqual(tags[-1], {'name': executor + 's'})
+                transaction.set_rollback(True)
+
+    def test_tracing(self):
+        class Tracer(tracing.Tracer):
+            def record(self, node):
+                records[node.name] = node
+
+        records = {}
+        template = {
+            'fields': ['user', 'signature', 'libraries'],
+            'related': {'libraries': {'fields': ['name', 'tags']}},
+            'posthook': lambda instance, attrs: attrs,
+        }
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            serialize(Hacker.objects.all(), tracer=Tracer(), **template)
+
+        self.assertEqual(caught, [])
+        self.assertEqual(records['tests.Hacker'].rows, 3)
+        self.assertEqual(records['tests.Hacker'].queries, 5)
+        self.assertEqual(records['user'].rows, 3)
+        self.assertEqual(records['libraries'].rows, 4)
+        self.assertEqual(records['libraries.tags'].rows, 6)
+        self.assertEqual(records['signature'].queries, 0)
+        self.assertEqual(records[':posthook'].calls, 3)
+
+        # Related objects are fetched per hacker without the optimizations
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            list(iter_serialize(Hacker.objects.all(), optimize=False,
+                                tracer=Tracer(), **template))
+
+        self.assertEqual(records['tests.Hacker'].rows, 3)
+        self.assertEqual(records['libraries'].query_calls, 3)
+        self.assertTrue(any(issubclass(x.category, tracing.NPlusOneWarning)
+                            for x in caught))
+
+    @unittest.skipIf(sys.version_info < (3, 6), 'requires Python 3.6')
+    def test_aserialize(self):
+        import asyncio
+        from preserialize import aio
+
+        loop = asyncio.new_event_loop()
+        run = loop.run_until_complete
+
+        def posthook(instance, attrs):
+            future = loop.create_future()
+            future.set_result(dict(attrs, pk=instance.pk))
+            return future
+
+        self.assertEqual(run(aio.aserialize(Hacker.objects.all(),
+                                            chunk_size=2)),
+                         serialize(Hacker.objects.all()))
+        self.assertEqual(run(aio.aserialize(Tag.objects.get(pk=3),
+                                            fields=['name'],
+                                            posthook=posthook)),
+                         {'name': 'python', 'pk': 3})
+        self.assertEqual(run(aio.aserialize(Tag.objects.all(),
+                                            fields=['name'],
+                                            posthook=posthook))[1],
+                         {'name': 'dom', 'pk': 2})
+
+        # The database is queried in another thread, not the event loop's
+        library = Library.objects.get(pk=1)
+        template = {'fields': ['name', 'tags']}
+
+        with CaptureQueriesContext(connection) as ctx:
+            libraries = run(aio.aserialize(Library.objects.all(),
+                                           chunk_size=3, **template))
+            attrs = run(aio.aserialize(library, **template))
+        self.assertEqual(len(ctx), 0)
+        self.assertEqual(libraries, serialize(Library.objects.all(),
+                                              **template))
+        self.assertEqual(attrs, serialize(library, **template))
+        loop.close()
+
+    def test_encode(self):
+        template = {'fields': ['username', 'last_login']}
+        users = User.objects.order_by('id')
+
+        chunks = list(encode.iter_json(users, **template))
+        self.assertTrue(all(isinstance(x, bytes) for x in chunks))
+        self.assertEqual(json.loads(b''.join(chunks).decode('utf-8')), [
+            {'username': 'ejohn', 'last_login': '2010-03-03T17:40:41'},
+            {'username': 'jashkenas', 'last_login': '2010-03-03T17:40:41'},
+            {'username': 'holovaty', 'last_login': '2010-03-03T17:40:41'},
+        ])
+
+        # Small buffers yield more chunks with the same output
+        encoder = encode.Encoder(buffer_size=1)
+        self.assertEqual(b''.join(encoder.iter_json(users, **template)),
+                         b''.join(chunks))
+
+        self.assertEqual(b''.join(encode.iter_json(users.none())), b'[]')
+        self.assertEqual(b''.join(encode.iter_json(self.tags[0])),
+                         b'{"id":1,"name":"javascript"}')
+
+        fp = io.StringIO()
+        encode.dump(users, fp, ndjson=True, fields=['username'])
+        self.assertEqual(fp.getvalue(), '{"username":"ejohn"}\n'
+                                        '{"username":"jashkenas"}\n'
+                                        '{"username":"holovaty"}\n')
+
+        fp = io.BytesIO()
+        encode.dump({'price': decimal.Decimal('1.50')}, fp)
+        self.assertEqual(fp.getvalue(), b'{"price":"1.50"}')
+
+    def test_accessors(self):
+        hacker = self.hackers[0]
+        library = Library.objects.get(pk=1)
+
+        objects = [
+            (hacker, ['website', 'user', 'user_id', 'libraries', 'signature',
+                      'pk']),
+            (library, ['name', 'tags', 'hackers']),
+            (hacker.user, ['profile', 'get_full_name', 'date_joined']),
+        ]
+
+        for obj, names in objects:
+            for name in names:
+                getter = utils.resolver.get_accessor(obj.__class__, name)
+                value = getter(obj)
+                expected = utils.get_field_value(obj, name)
+
+                if isinstance(value, QuerySet):
+                    value, expected = list(value), list(expected)
+
+                self.assertEqual(value, expected)
+
+        # Missing attributes are handled by `get_field_value`
+        getter = utils.resolver.get_accessor(User, 'profile')
+        user = User.objects.create(username='nohacker')
+        self.assertRaises(ValueError, getter, user)
+        self.assertEqual(getter(user, allow_missing=True), None)
+        user.delete()
+
+    def test_generic_relation(self):
+        article = Article.objects.create(title='Release')
+        Note.objects.create(content_object=article, text='Draft')
+        template = {'fields': ['title', 'notes'],
+                    'related': {'notes': {'fields': ['text']}}}
+        expected = {'title': 'Release', 'notes': [{'text': 'Draft'}]}
+
+        self.assertEqual(serialize(article, **template), expected)
+        self.assertEqual(serialize(Article.objects.filter(pk=article.pk),
+                                   **template), [expected])
+        self.assertEqual(serialize(Article.objects.filter(pk=article.pk),
+                                   codegen=True, **template), [expected])
+
+        article.notes.all().delete()
+        article.delete()
+
+    def test_resolver_cache(self):
+        # Warmed up when the app registry is ready
+        resolver = utils.resolver
+        for model in apps.get_models():
+            self.assertTrue(model in resolver.cache)
+
+        plan = compile(Hacker, fields=['website'])
+        resolver.get_accessor(Hacker, 'website')
+
+        # Preparing a model class invalidates it and the models it relates
+        # to, along with the compiled plans
+        class_prepared.send(sender=Hacker)
+        for model in (Hacker, User, Library):
+            self.assertFalse(model in resolver.cache)
+        self.assertFalse(Hacker in resolver.accessors)
+        self.assertTrue(Tag in resolver.cache)
+        self.assertFalse(compile(Hacker, fields=['website']) is plan)
+
+        invalidated = []
+        resolver = utils.ModelFieldResolver(max_size=2)
+        resolver.listeners.append(invalidated.append)
+        resolver.warm([Tag, Library, Hacker])
+        self.assertEqual(list(resolver.cache), [Library, Hacker])
+
+        resolver.invalidate(Library)
+        resolver.clear()
+        self.assertEqual(list(resolver.cache), [])
+        self.assertEqual(invalidated, [Library, None])
+
+    def test_cache(self):
+        lru = cache.LRUCache()
+        template = {
+            'fields': ['name', 'libraries'],
+            'related': {'libraries': {'fields': ['name'],
+                                      'values_list': True}},
+            'cache': lru,
+        }
+        expected = serialize(Tag.objects.all(), **dict(template, cache=False))
+
+        # Changing the serialized objects does not change the cached ones
+        obj = serialize(Tag.objects.all(), **template)
+        obj[0]['libraries'].append('Ember.js')
+
+        # Only the tags are queried once the objects are cached
+        with CaptureQueriesContext(connection) as ctx:
+            obj = serialize(Tag.objects.all(), **template)
+        self.assertEqual(obj, expected)
+        self.assertEqual(len(ctx), 1)
+
+        obj[0]['name'] = 'JavaScript'
+        self.assertEqual(serialize(Tag.objects.all(), **template), expected)
+
+        # Hooks bound to objects that cannot be described are not cached
+        # under the same key
+        class Hook(object):
+            def posthook(self, obj, attrs):
+                return attrs
+
+        self.assertRaises(ValueError, serialize, Tag.objects.all(),
+                          **dict(template, posthook=Hook().posthook))
+
+        # Changing a related object invalidates the objects including it
+        lib = Library.objects.get(pk=2)
+        lib.name = 'Backbone.js'
+        lib.save()
+        obj = serialize(Tag.objects.all(), **template)
+        self.assertEqual(obj[0]['libraries'],
+                         ['jQuery', 'Backbone.js', 'CoffeeScript'])
+
+        # As does changing a many-to-many relation from either side
+        Tag.objects.get(pk=2).libraries.remove(1)
+        obj = serialize(Tag.objects.all(), **template)
+        self.assertEqual(obj[1], {'name': 'dom', 'libraries': []})
+
+        Library.objects.get(pk=4).tags.clear()
+        obj = serialize(Tag.objects.all(), **template)
+        self.assertEqual(obj[2], {'name': 'python', 'libraries': []})
+
+        # Instances and Django cache aliases
+        template['cache'] = True
+        self.assertEqual(serialize(Tag.objects.get(pk=2), **template),
+                         {'name': 'dom', 'libraries': []})
+
+    def test_fingerprint(self):
+        def nested(obj):
+            return obj
+
+        template = {'fields': ['name'], 'posthook': utils.get_field_value}
+        self.assertEqual(utils.fingerprint(template),
+                         utils.fingerprint(dict(template, cache=True)))
+        self.assertNotEqual(utils.fingerprint(template),
+                            utils.fingerprint(dict(template, prefix='x')))
+        self.assertRaises(ValueError, utils.fingerprint,
+                          dict(template, posthook=nested))
+        self.assertNotEqual(
+            utils.fingerprint(dict(template, posthook=nested), 'identity'),
+            utils.fingerprint(dict(template, posthook=lambda o, a: a),
+                              'identity'))
+
+        # Methods are bound to different objects
+        class Hook(object):
+            def posthook(self, obj, attrs):
+                return attrs
+
+        first, second = Hook(), Hook()
+        self.assertRaises(ValueError, utils.fingerprint,
+                          dict(template, posthook=first.posthook))
+        self.assertNotEqual(
+            utils.fingerprint(dict(template, posthook=first.posthook),
+                              'identity'),
+            utils.fingerprint(dict(template, posthook=second.posthook),
+                              'identity'))
+        self.assertNotEqual(
+            utils.fingerprint(dict(template, posthook=self.hackers[0].save)),
+            utils.fingerprint(dict(template, posthook=self.hackers[1].save)))
+
+    def test_template(self):
+        t1 = template.Template(fields=['name', 'hackers'], related={
+            'hackers': {'fields': ['user'], 'related': {
+                'user': {'fields': ['username']}}},
+        })
+        t2 = template.Template({'related': t1['related'],
+                                'fields': ('name', 'hackers')})
+
+        self.assertEqual(t1, t2)
+        self.assertEqual(len(set([t1, t2])), 1)
+        self.assertEqual(t1['fields'], ('name', 'hackers'))
+        self.assertTrue(isinstance(t1['related']['hackers'],
+                                   template.Template))
+        self.assertNotEqual(t1, t1.copy(camelcase=True))
+        self.assertTrue(t1.plan(Library) is t2.plan(Library))
+
+        # Nested options cannot be changed either
+        t3 = t1.copy(aliases={'title': 'name'}, prehook={'pk__gt': 1})
+
+        with self.assertRaises(TypeError):
+            t3['aliases']['x'] = 'y'
+        with self.assertRaises(TypeError):
+            t3['related']['tags'] = {}
+        self.assertEqual(t3, template.Template(dict(t3)))
+        self.assertEqual(t3.copy(), t3)
+        self.assertEqual(len(t3.serialize(Library.objects.all())), 3)
+
+        obj = t1.serialize(Library.objects.all())
+        self.assertEqual(obj, serialize(Library.objects.all(), **t1))
+        self.assertEqual(obj[0]['hackers'][0]['user'], 'ejohn')
+
+        template.register('library', t1)
+        self.assertTrue('library' in template.registry)
+        self.assertTrue(template.get_template('library') is t1)
+        template.unregister('library')
+        self.assertRaises(LookupError, template.get_template, 'library')
+        self.assertRaises(ValueError, template.Template,
+                          posthook=lambda o, a: a)
+
+    def test_identity(self):
+        template = {'fields': ['name', 'tags'],
+                    'related': {'tags': {'fields': ['id', 'name']}}}
+
+        # Shared related objects are serialized once
+        libraries = serialize(Library.objects.all(), identity=True,
+                              **template)
+        self.assertEqual(libraries, serialize(Library.objects.all(),
+                                              **template))
+        self.assertTrue(libraries[0]['tags'][0] is libraries[1]['tags'][0])
+
+        # Foreign keys that were already serialized are not fetched
+        hackers = [Hacker.objects.get(pk=2), Hacker.objects.get(pk=2)]
+
+        with CaptureQueriesContext(connection) as ctx:
+            serialize(hackers, fields=['user'], identity=True, related={
+                'user': {'fields': ['username', 'email']}})
+        self.assertEqual(len(ctx), 1)
+
+        data = serialize(Library.objects.filter(pk__in=[1, 2]),
+                         normalize=True, **template)
+        self.assertEqual(data, {
+            'data': [{'name': 'jQuery', 'tags': [1, 2]},
+                     {'name': 'Backbone', 'tags': [1]}],
+            'included': {'tests.Tag': {
+                1: {'id': 1, 'name': 'javascript'},
+                2: {'id': 2, 'name': 'dom'},
+            }},
+        })
+
+        # Normalized objects are not cached, their references would not be
+        # included in other calls
+        lru = cache.LRUCache()
+        queryset = Library.objects.filter(pk__in=[1, 2])
+
+        for i in range(2):
+            self.assertEqual(serialize(queryset, normalize=True, cache=lru,
+                                       **template), data)
+
+        self.assertEqual(serialize(queryset, cache=lru, **template),
+                         serialize(queryset, **template))
+
+    def test_codegen(self):
+        template = {
+            'fields': ['user', 'website', 'libraries', 'signature'],
+            'related': {
+                'user': {'fields': ['username', 'email']},
+                'libraries': {'fields': ['name', 'tags']},
+            },
+        }
+
+        func = codegen.compile(Hacker, **template)
+        self.assertTrue("attrs['website'] = " in func.source)
+        self.assertEqual(func, codegen.compile(Hacker, **template))
+
+        hacker = Hacker.objects.get(pk=1)
+        self.assertEqual(func(hacker), serialize(hacker, **template))
+        self.assertEqual(serialize(Hacker.objects.all(), codegen=True,
+                                   **template),
+                         serialize(Hacker.objects.all(), **template))
+
+    def test_related_limit(self):
+        template = {
+            'fields': ['name', 'tags'],
+            'aggregates': {'tag_count': 'count:tags'},
+            'related': {'tags': {'fields': ['name'], 'ordering': ['-name'],
+                                 'limit': 1}},
+        }
+        expected = [
+            {'name': 'jQuery', 'tags': [{'name': 'javascript'}],
+             'tag_count': 2},
+            {'name': 'Backbone', 'tags': [{'name': 'javascript'}],
+             'tag_count': 1},
+            {'name': 'CoffeeScript', 'tags': [{'name': 'javascript'}],
+             'tag_count': 1},
+            {'name': 'Django', 'tags': [{'name': 'python'}],
+             'tag_count': 2},
+        ]
+
+        # The tags of all libraries are prefetched by one query
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(serialize(Library.objects.all(), **template),
+                             expected)
+        self.assertEqual(len(ctx), 2)
+
+        self.assertEqual(serialize(Library.objects.all(), optimize=False,
+                                   **template), expected)
+
+        # Databases with window functions only fetch the first related
+        # objects of each parent
+        windows = _supports_window(connection)
+
+        def fetched(model, template):
+            plan = compile(model, **template)
+            field = plan.fields[1]
+            objects = plan.prepare(model.objects.order_by('pk'))
+            return [len(x.__dict__[field.prefetch_attr]) for x in objects]
+
+        self.assertEqual(fetched(Library, template),
+                         [1, 1, 1, 1] if windows else [2, 1, 1, 2])
+
+        # Objects of reverse relations, ordered by the model's default
+        self.assertEqual(fetched(Tag, {
+            'fields': ['name', 'libraries'],
+            'related': {'libraries': {'fields': ['name'], 'limit': 2}}}),
+            [2, 1, 1, 1] if windows else [3, 1, 1, 1])
+
+        root = Category.objects.create(name='Languages')
+
+        for name in ['Python', 'Ruby', 'Go']:
+            Category.objects.create(name=name, parent=root)
+
+        template = {'fields': ['name', 'children'], 'related': {
+            'children': {'fields': ['name'], 'ordering': ['name'],
+                         'limit': 2}}}
+        self.assertEqual(fetched(Category, template)[0],
+                         2 if windows else 3)
+        self.assertEqual(serialize(root, **template), {
+            'name': 'Languages',
+            'children': [{'name': 'Go'}, {'name': 'Python'}]})
+        self.assertEqual(serialize(Category.objects.filter(pk=root.pk),
+                                   **template), [{
+            'name': 'Languages',
+            'children': [{'name': 'Go'}, {'name': 'Python'}]}])
+
+        Category.objects.update(parent=None)
+        Category.objects.all().delete()
+
+    def test_fieldsets(self):
+        template = {
+            'fields': ['id', 'name', 'url', 'tags', 'hackers'],
+            'aggregates': {'tag_count': 'count:tags'},
+            'related': {'tags': {'fields': ['id', 'name']}},
+        }
+
+        self.assertEqual(fieldsets.parse(' name, tags.name,tags.id'), {
+            'name': {}, 'tags': {'name': {}, 'id': {}}})
+
+        pruned = fieldsets.prune(Library, template, 'name,tags.name')
+
+        with CaptureQueriesContext(connection) as ctx:
+            libraries = serialize(Library.objects.filter(pk=1), **pruned)
+        self.assertEqual(libraries, [{'name': 'jQuery', 'tags': [
+            {'name': 'javascript'}, {'name': 'dom'}]}])
+        self.assertEqual(len(ctx), 2)
+        self.assertTrue('url' not in ctx.captured_queries[0]['sql'])
+
+        pruned = fieldsets.prune(Library, template,
+                                 'tag_count,hackers.website')
+        self.assertEqual(serialize(Library.objects.filter(pk=1), **pruned),
+                         [{'hackers': [{'website': 'http://ejohn.org'}],
+                           'tag_count': 2}])
+
+        # No fields or only aggregates do not select the default fields
+        self.assertEqual(
+            serialize(Library.objects.filter(pk=1),
+                      **fieldsets.prune(Library, template, 'tag_count')),
+            [{'tag_count': 2}])
+        with CaptureQueriesContext(connection) as ctx:
+            self.assertEqual(
+                serialize(Library.objects.filter(pk=1),
+                          **fieldsets.prune(Library, template, '')), [{}])
+        self.assertTrue('url' not in ctx.captured_queries[0]['sql'])
+
+        # Fields excluded by the template stay excluded
+        pruned = fieldsets.prune(User, {'exclude': ['password']}, '')
+        self.assertEqual(serialize(User.objects.get(pk=1), **pruned), {})
+        pruned = fieldsets.prune(User, {'exclude': ['password']}, 'id')
+        self.assertEqual(serialize(User.objects.get(pk=1), **pruned),
+                         {'id': 1})
+        self.assertRaises(ValueError, fieldsets.prune, User,
+                          {'exclude': ['password']}, 'password')
+
+        for expression in ['language', 'tags.url', 'name.first', 'tags..']:
+            self.assertRaises(ValueError, fieldsets.prune, Library, template,
+                              expression)
+
+    def test_conditional(self):
+        template = {'fields': ['user', 'website', 'libraries'],
+                    'related': {'user': {'fields': ['username']}}}
+
+        with CaptureQueriesContext(connection) as ctx:
+            etag, modified = conditional.validators(
+                Hacker.objects.all(), 'last_login', **template)
+        self.assertEqual(len(ctx), 1)
+        self.assertEqual(modified, datetime.datetime(2010, 3, 3, 17, 40, 41))
+
+        # Changes of the related objects in the template
+        User.objects.filter(pk=2).update(
+            last_login=datetime.datetime(2011, 1, 1))
+        changed, modified = conditional.validators(
+            Hacker.objects.all(), 'last_login', **template)
+        self.assertEqual(modified, datetime.datetime(2011, 1, 1))
+        self.assertNotEqual(changed, etag)
+
+        # The number of objects and the template
+        etag = conditional.validators(User.objects.all(), 'last_login')[0]
+        self.assertNotEqual(etag, conditional.validators(
+            User.objects.all(), 'last_login', fields=['username'])[0])
+
+        user = User.objects.create(username='new')
+        try:
+            self.assertNotEqual(etag, conditional.validators(
+                User.objects.all(), 'last_login')[0])
+        finally:
+            user.delete()
+
+        # Changes in place are only detected by the modification time
+        self.assertRaises(ValueError, conditional.validators,
+                          Tag.objects.all(), 'last_login')
+        self.assertRaises(ValueError, conditional.validators,
+                          Tag.objects.all(), None)
+
+        @conditional.condition(lambda request: User.objects.all(),
+                               'last_login')
+        def view(request):
+            return HttpResponse()
+
+        request = RequestFactory().get('/', HTTP_IF_NONE_MATCH='"{0}"'
+                                       .format(etag))
+        self.assertEqual(view(request).status_code, 304)
+
+    def test_serialize_changes(self):
+        template = {'fields': ['user', 'website'],
+                    'related': {'user': {'fields': ['username']}}}
+
+        data = changes.serialize_changes(Hacker.objects.all(),
+                                         modified_field='last_login',
+                                         tombstones=Tombstone, **template)
+        self.assertEqual(len(data['changed']), 3)
+        self.assertEqual(data['deleted'], [])
+
+        since = changes.encode_checkpoint(datetime.datetime(2010, 6, 1))
+        self.assertEqual(changes.serialize_changes(
+            Hacker.objects.all(), since, 'last_login', Tombstone,
+            **template)['changed'], [])
+
+        # A change of a related object marks the hacker as changed
+        User.objects.filter(pk=2).update(
+            last_login=datetime.datetime(2011, 1, 1))
+        receiver = changes.track_deletions(Hacker, Tombstone)
+
+        try:
+            Hacker.objects.get(pk=3).delete()
+        finally:
+            post_delete.disconnect(receiver)
+
+        try:
+            data = changes.serialize_changes(Hacker.objects.all(), since,
+                                             'last_login', Tombstone,
+                                             **template)
+        finally:
+            Tombstone.objects.all().delete()
+
+        self.assertEqual(data['changed'], [
+            {'user': 'jashkenas', 'website': 'https://github.com/jashkenas'}])
+        self.assertEqual(data['deleted'], [3])
+        self.assertTrue(changes.decode_checkpoint(data['checkpoint']) >
+                        datetime.datetime(2011, 1, 1))
+
+        self.assertRaises(ValueError, changes.serialize_changes,
+                          Hacker.objects.all(), 'x', 'last_login')
+        self.assertRaises(ValueError, changes.serialize_changes,
+                          Tag.objects.all(), None, 'last_login')
+
+    def test_values_queryset(self):
+        # Rows of `values` querysets are serialized without optimizations
+        queryset = Hacker.objects.values('user', 'website')
+        expected = [{'user': 1, 'website': 'http://ejohn.org'},
+                    {'user': 2, 'website': 'https://github.com/jashkenas'},
+                    {'user': 3, 'website': 'http://holovaty.com'}]
+
+        self.assertEqual(serialize(queryset, fields=['user', 'website']),
+                         expected)
+        self.assertEqual(list(iter_serialize(queryset,
+                                             fields=['user', 'website'])),
+                         expected)
+
+        # Rows are not cached, only model instances are
+        lru = cache.LRUCache()
+
+        for i in range(2):
+            self.assertEqual(serialize(queryset, fields=['user', 'website'],
+                                       cache=lru), expected)
+            self.assertEqual(list(iter_serialize(
+                queryset, fields=['user', 'website'], cache=lru)), expected)